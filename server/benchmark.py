@@ -0,0 +1,520 @@
+"""Offline benchmark for the scheduler tick and the chat path.
+
+Swaps the Supabase client, the Telegram bot and the Gemini model for
+in-process fakes with configurable latency and failure rates, generates a
+synthetic population and reports tick duration, per-reminder lateness and
+chat throughput. Nothing talks to a live service.
+
+    python benchmark.py --users 100000 --output bench_results.jsonl
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+# Placeholders so module-level clients can be constructed; they are replaced before use
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_KEY", "bench.bench.bench")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+os.environ.setdefault("GEMINI_API_KEY", "bench")
+
+import database
+import llm
+import dispatcher
+import scheduler
+import telegram_bot
+import due_queue as due_queue_module
+from due_queue import due_queue
+from conversation_log import conversation_log
+from outbox import outbox
+from history_summary import history_summarizer
+from repository import repository
+from metrics import TELEGRAM_SEND_SECONDS
+
+PEAK_SLOTS = ["08:00", "14:00", "20:00"]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class FakeFailure(Exception):
+    pass
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    """Just enough of the postgrest query builder for this codebase."""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table_name = table
+        self.action = "select"
+        self.payload = None
+        self.filters = []
+        self.ordering = None
+        self.limit_count = None
+        self.offset = 0
+
+    def select(self, *columns):
+        self.action = "select"
+        return self
+
+    def insert(self, rows):
+        self.action, self.payload = "insert", rows
+        return self
+
+    def upsert(self, rows, on_conflict="", ignore_duplicates=False):
+        self.action, self.conflict, self.ignore_duplicates = "upsert", on_conflict, ignore_duplicates
+        self.payload = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def update(self, values):
+        self.action, self.payload = "update", values
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, {value}))
+        return self
+
+    def in_(self, column, values):
+        self.filters.append((column, set(values)))
+        return self
+
+    def order(self, column, desc=False):
+        self.ordering = (column, desc)
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def range(self, start, end):
+        self.offset, self.limit_count = start, end - start + 1
+        return self
+
+    def _matches(self):
+        rows = self.db.tables[self.table_name]
+        if not self.filters:
+            return list(rows)
+        column, values = self.filters[0]
+        index = self.db.index(self.table_name, column)
+        candidates = [row for value in values for row in index.get(value, ())]
+        return [row for row in candidates if all(row.get(c) in v for c, v in self.filters[1:])]
+
+    def execute(self):
+        self.db.round_trip()
+        table = self.db.tables[self.table_name]
+        if self.action == "upsert":
+            existing = self.db.index(self.table_name, self.conflict)
+            if not self.ignore_duplicates:
+                for row in self.payload:
+                    for match in existing.get(row[self.conflict], ()):
+                        match.update(row)
+            self.payload = [row for row in self.payload if row[self.conflict] not in existing]
+            self.action = "insert"
+        if self.action == "insert":
+            rows = self.payload if isinstance(self.payload, list) else [self.payload]
+            inserted = [{"id": str(uuid.uuid4()), **row} for row in rows]
+            table.extend(inserted)
+            self.db.invalidate(self.table_name)
+            return FakeResponse([dict(row) for row in inserted])
+        matches = self._matches()
+        if self.action == "update":
+            for row in matches:
+                row.update(self.payload)
+            self.db.invalidate(self.table_name, self.payload)
+            return FakeResponse([dict(row) for row in matches])
+        if self.action == "delete":
+            doomed = {id(row) for row in matches}
+            self.db.tables[self.table_name] = [row for row in table if id(row) not in doomed]
+            self.db.invalidate(self.table_name)
+            return FakeResponse([dict(row) for row in matches])
+        if self.ordering:
+            column, desc = self.ordering
+            matches.sort(key=lambda row: row.get(column) or "", reverse=desc)
+        matches = matches[self.offset:]
+        if self.limit_count is not None:
+            matches = matches[:self.limit_count]
+        return FakeResponse([dict(row) for row in matches])
+
+
+class FakeRpc:
+    def __init__(self, db, function):
+        self.db = db
+        self.function = function
+
+    def execute(self):
+        self.db.round_trip()
+        return FakeResponse(self.function())
+
+
+class FakeSupabase:
+    """In-memory stand-in for the sync Supabase client.
+
+    Every ``execute`` sleeps for ``latency`` seconds, blocking the calling
+    thread the way the real HTTP client does, and fails with probability
+    ``failure_rate``. The functions from ``supabase_schema.sql`` that the code
+    calls through ``rpc`` are mirrored in Python.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.tables = {
+            "users": [], "medications": [], "reminders": [], "conversations": [], "reminder_outbox": [],
+            "schedule_entries": [], "conversation_summaries": [],
+        }
+        self.round_trips = 0
+        self._indexes = {}
+        self._version = 0  # Bumped on writes so the schedule_entries view is rebuilt lazily
+        self._view_version = None
+
+    def table(self, name):
+        if name == "schedule_entries" and self._view_version != self._version:
+            self.tables[name] = self.schedule_entries()
+            self.invalidate(name)
+            self._view_version = self._version
+        return FakeQuery(self, name)
+
+    def schedule_entries(self):
+        users = {user["phone"]: user for user in self.tables["users"]}
+        entries = []
+        for kind, table in (("medication", "medications"), ("reminder", "reminders")):
+            for row in self.tables[table]:
+                user = users.get(row["user_phone"], {})
+                entries.append({
+                    "kind": kind, "frequency": "daily", **row, "slot": due_queue_module.slot_of(row["time"]),
+                    "telegram_id": user.get("telegram_id"), "user_name": user.get("name"),
+                    "shard_hash": due_queue_module.shard_hash(row["user_phone"]),
+                })
+        return entries
+
+    @staticmethod
+    def _in_shards(row, shards, shard_count):
+        return shards is None or row["shard_hash"] % shard_count in shards
+
+    def schedules_in_shards(self, p_shards=None, p_shard_count=None, p_after=None, p_limit=1000):
+        self.table("schedule_entries")  # Refresh the view
+        rows = sorted((
+            row for row in self.tables["schedule_entries"]
+            if self._in_shards(row, p_shards, p_shard_count) and (p_after is None or row["id"] > p_after)
+        ), key=lambda row: row["id"])
+        return [dict(row) for row in rows[:p_limit]]
+
+    def due_in_minute(self, p_slot, p_window=1, p_shards=None, p_shard_count=None, p_after_slot=None, p_after=None,
+                      p_limit=1000):
+        slots = {(p_slot + offset) % due_queue_module.MINUTES_PER_DAY for offset in range(-p_window, p_window + 1)}
+        rows = sorted((
+            row for row in self.schedule_entries()
+            if (row["slot"] in slots or (row["frequency"] == "every6hours" and row["slot"] % 360 in {s % 360 for s in slots}))
+            and self._in_shards(row, p_shards, p_shard_count)
+            and (p_after is None or (row["slot"], row["id"]) > (p_after_slot, p_after))
+        ), key=lambda row: (row["slot"], row["id"]))
+        return [dict(row) for row in rows[:p_limit]]
+
+    def recent_conversations(self, p_phones, p_per_user=1):
+        rows = []
+        for phone in p_phones:
+            turns = sorted(self.index("conversations", "user_phone").get(phone, ()), key=lambda row: row["timestamp"], reverse=True)
+            rows.extend(dict(row) for row in turns[:p_per_user])
+        return rows
+
+    def rpc(self, name, params):
+        return FakeRpc(self, lambda: getattr(self, name)(**params))
+
+    def claim_outbox(self, p_owner, p_now, p_lease_seconds, p_limit):
+        now = datetime.fromisoformat(p_now)
+        ready = sorted((
+            row for row in self.tables["reminder_outbox"]
+            if row.get("status", "pending") == "pending" and row["next_attempt_at"] <= p_now
+            and (row.get("lease_expires_at") is None or row["lease_expires_at"] < p_now)
+        ), key=lambda row: row["next_attempt_at"])[:p_limit]
+        for row in ready:
+            row.update({
+                "status": "pending", "lease_owner": p_owner, "attempts": row.get("attempts", 0) + 1,
+                "lease_expires_at": (now + timedelta(seconds=p_lease_seconds)).isoformat(),
+            })
+        self.invalidate("reminder_outbox")
+        return [dict(row) for row in ready]
+
+    def round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise FakeFailure("injected database failure")
+
+    def index(self, table, column):
+        key = (table, column)
+        if key not in self._indexes:
+            index = {}
+            for row in self.tables[table]:
+                index.setdefault(row.get(column), []).append(row)
+            self._indexes[key] = index
+        return self._indexes[key]
+
+    def invalidate(self, table, columns=None):
+        if table != "schedule_entries":
+            self._version += 1
+        for key in list(self._indexes):
+            if key[0] == table and (columns is None or key[1] in columns):
+                del self._indexes[key]
+
+
+class FakeGeminiResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGemini:
+    def __init__(self, latency=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+
+    async def generate_content_async(self, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise FakeFailure("injected Gemini failure")
+        if "Current message:" in prompt:
+            return FakeGeminiResponse(json.dumps({
+                "medication": [], "reminders": [], "response": "Stay hydrated and rest well, Love! 💖",
+            }))
+        return FakeGeminiResponse("Time for your meds, Baby! 💖 Drink some water with them. How do you feel? 😘")
+
+
+class FakeBot:
+    def __init__(self, latency=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent_at = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise FakeFailure("injected Telegram failure")
+        self.sent_at.append(time.monotonic())
+
+
+class FakeMessage:
+    def __init__(self, text, bot):
+        self.text = text
+        self.bot = bot
+
+    async def reply_text(self, text, **kwargs):
+        await self.bot.send_message(None, text)
+
+
+class FakeUser:
+    def __init__(self, user_id, first_name):
+        self.id = user_id
+        self.first_name = first_name
+
+
+class FakeUpdate:
+    def __init__(self, user, text, bot):
+        self.effective_user = user
+        self.message = FakeMessage(text, bot)
+
+
+class FakeContext:
+    def __init__(self):
+        self.user_data = {}
+
+
+class FrozenClock(datetime):
+    """datetime whose now() returns a settable instant, for driving the scheduler."""
+
+    frozen = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.frozen
+
+
+def install_fakes(db, bot, gemini, global_rate):
+    """Point every module that captured a real client at the fakes."""
+    for module in list(sys.modules.values()):
+        if getattr(module, "supabase", None) is database.supabase and module is not database:
+            module.supabase = db
+    database.supabase = db
+    repository.supabase = db
+    scheduler.bot = bot
+    llm.gemini_model = gemini
+    scheduler.rate_limiter = dispatcher.TelegramRateLimiter(global_rate=global_rate)
+    scheduler.datetime = FrozenClock
+
+
+def populate(db, users, meds_per_user, reminder_share, history_turns, seed):
+    """Create users with medications clustered at peak slots plus some reminders."""
+    rng = random.Random(seed)
+    started = datetime(2026, 1, 1)
+    for n in range(users):
+        phone = f"tg_{n}"
+        db.tables["users"].append({"id": str(uuid.uuid4()), "name": f"User{n}", "phone": phone, "telegram_id": str(n)})
+        for _ in range(meds_per_user):
+            slot = rng.choice(PEAK_SLOTS) if rng.random() < 0.9 else f"{rng.randrange(24):02d}:{rng.randrange(60):02d}"
+            db.tables["medications"].append({
+                "id": str(uuid.uuid4()), "user_phone": phone, "name": rng.choice(["Fexet", "Moxikind", "Predni"]),
+                "quantity": rng.randint(1, 2), "meal_timing": rng.choice(["before", "after"]),
+                "frequency": "every6hours" if rng.random() < 0.05 else "daily",
+                "time": slot, "sent": False, "last_sent_at": None,
+            })
+        if rng.random() < reminder_share:
+            db.tables["reminders"].append({
+                "id": str(uuid.uuid4()), "user_phone": phone, "task": "drink water",
+                "time": rng.choice(PEAK_SLOTS), "sent": False, "last_sent_at": None,
+            })
+        for turn in range(history_turns):
+            db.tables["conversations"].append({
+                "id": str(uuid.uuid4()), "user_phone": phone, "user_message": "fexet night 1",
+                "bot_response": "Got it, Love! 💖", "timestamp": (started + timedelta(minutes=turn)).isoformat(),
+            })
+
+
+async def bench_scheduler(args, db, bot):
+    """Load the due-queue, pre-render ahead of the peak slot and run its tick."""
+    results = {}
+    slot = datetime(2026, 1, 2, 8, 0)
+
+    started = time.perf_counter()
+    due_queue.replace(await repository.schedules())
+    results["queue_load_seconds"] = time.perf_counter() - started
+    results["schedules"] = len(due_queue)
+
+    round_trips = db.round_trips
+    FrozenClock.frozen = slot - timedelta(minutes=args.prerender_lead)
+    started = time.perf_counter()
+    await scheduler.prerender_upcoming()
+    results["prerender_seconds"] = time.perf_counter() - started
+    results["prerender_round_trips"] = db.round_trips - round_trips
+
+    round_trips = db.round_trips
+    bot.sent_at.clear()
+    FrozenClock.frozen = slot
+    tick_started = time.monotonic()
+    await scheduler.check_and_send_reminders()
+    results["tick_seconds"] = time.monotonic() - tick_started
+    results["tick_round_trips"] = db.round_trips - round_trips
+    lateness = [sent - tick_started for sent in bot.sent_at]
+    results["reminders_sent"] = len(lateness)
+    results["lateness_p50"] = percentile(lateness, 50)
+    results["lateness_p95"] = percentile(lateness, 95)
+    results["lateness_max"] = max(lateness, default=0.0)
+    results["late_over_60s"] = sum(1 for value in lateness if value > 60)
+    results["outbox_retried"] = outbox.stats["retried"]
+    results["outbox_dead"] = outbox.stats["dead"]
+    results["telegram_send_p95"] = TELEGRAM_SEND_SECONDS.percentile(95)
+    return results
+
+
+async def bench_chat(args, db, bot, gemini):
+    """Drive handle_message with a mix of fast-path and free-text messages."""
+    rng = random.Random(args.seed)
+    texts = ["fexet night 1", "drink water at 4:45 pm", "i have a cold", "going to a party tonight", "yes"]
+    contexts = {}
+    latencies, errors = [], []
+    queue = asyncio.Queue()
+    for n in range(args.messages):
+        queue.put_nowait((rng.randrange(args.chat_users), rng.choice(texts)))
+    conversation_log.start()
+
+    async def worker():
+        while not queue.empty():
+            user_id, text = queue.get_nowait()
+            update = FakeUpdate(FakeUser(user_id, f"User{user_id}"), text, bot)
+            context = contexts.setdefault(user_id, FakeContext())
+            started = time.monotonic()
+            try:
+                await telegram_bot.handle_message(update, context)
+            except FakeFailure:
+                # The Application's error handler would swallow this in production
+                errors.append(user_id)
+            latencies.append(time.monotonic() - started)
+
+    round_trips, llm_calls = db.round_trips, gemini.calls
+    started = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(args.chat_concurrency)))
+    elapsed = time.monotonic() - started
+    await history_summarizer.stop()
+    await conversation_log.stop()
+    return {
+        "chat_messages": args.messages,
+        "chat_seconds": elapsed,
+        "chat_messages_per_second": args.messages / elapsed if elapsed else 0.0,
+        "chat_latency_p50": percentile(latencies, 50),
+        "chat_latency_p95": percentile(latencies, 95),
+        "chat_errors": len(errors),
+        "chat_round_trips": db.round_trips - round_trips,
+        "chat_llm_calls": gemini.calls - llm_calls,
+        "summary_updates": history_summarizer.stats["updates"],
+    }
+
+
+async def run(args):
+    db = FakeSupabase(args.db_latency, args.db_failure_rate)
+    bot = FakeBot(args.telegram_latency, args.telegram_failure_rate)
+    gemini = FakeGemini(args.llm_latency, args.llm_failure_rate)
+    install_fakes(db, bot, gemini, args.global_rate)
+    populate(db, args.users, args.meds_per_user, args.reminder_share, args.history_turns, args.seed)
+
+    if args.quiet:
+        logging.getLogger().setLevel(logging.WARNING)
+    results = await bench_scheduler(args, db, bot)
+    results.update(await bench_chat(args, db, bot, gemini))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--meds-per-user", type=int, default=1)
+    parser.add_argument("--reminder-share", type=float, default=0.2, help="fraction of users with a reminder")
+    parser.add_argument("--history-turns", type=int, default=2)
+    parser.add_argument("--db-latency", type=float, default=0.005, help="seconds per Supabase round trip")
+    parser.add_argument("--db-failure-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--telegram-failure-rate", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.8)
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    parser.add_argument("--global-rate", type=float, default=1000.0,
+                        help="Telegram sends/second allowed by the limiter (the real API allows ~30)")
+    parser.add_argument("--prerender-lead", type=int, default=10, help="minutes before the slot to pre-render")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--chat-users", type=int, default=500)
+    parser.add_argument("--chat-concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="append results as a JSON line to this file")
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="keep the bot's own INFO logs")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    for name, value in results.items():
+        print(f"{name:>28}: {value:.3f}" if isinstance(value, float) else f"{name:>28}: {value}")
+    if args.output:
+        record = {"timestamp": datetime.now().isoformat(), "args": vars(args), "results": results}
+        with open(args.output, "a", encoding="utf-8") as out:
+            out.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
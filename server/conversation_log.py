@@ -0,0 +1,153 @@
+import os
+import json
+import asyncio
+import logging
+from collections import deque
+from repository import repository, is_rejected
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_BATCH_SIZE = int(os.getenv("CONVERSATION_BATCH_SIZE", "100"))
+CONVERSATION_FLUSH_SECONDS = float(os.getenv("CONVERSATION_FLUSH_SECONDS", "2"))
+CONVERSATION_MAX_BACKLOG = int(os.getenv("CONVERSATION_MAX_BACKLOG", "10000"))
+CONVERSATION_SPILL_PATH = os.getenv("CONVERSATION_SPILL_PATH")  # JSONL file for overflow; dropped if unset
+MAX_BACKOFF_SECONDS = 60
+
+
+class ConversationLog:
+    """Write-behind buffer that saves conversation rows with bulk inserts.
+
+    Rows are flushed when ``batch_size`` rows are waiting or every
+    ``flush_interval`` seconds, and on ``stop``. If Supabase falls behind and
+    the backlog exceeds ``max_backlog``, the oldest rows are appended to
+    ``spill_path`` (and re-queued on the next start) or dropped. A batch the
+    database rejects is split until the offending rows are found, and only
+    those are dropped, so one bad row can't hold up everyone else's.
+    """
+
+    def __init__(self, repository, batch_size=CONVERSATION_BATCH_SIZE, flush_interval=CONVERSATION_FLUSH_SECONDS,
+                 max_backlog=CONVERSATION_MAX_BACKLOG, spill_path=CONVERSATION_SPILL_PATH):
+        self.repository = repository
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backlog = max_backlog
+        self.spill_path = spill_path
+        self._rows = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.stats = {"appended": 0, "flushed": 0, "inserts": 0, "failures": 0, "spilled": 0, "dropped": 0, "rejected": 0}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def append(self, row):
+        """Queue a conversation row without waiting on the database."""
+        if len(self._rows) >= self.max_backlog:
+            self._overflow(self._rows.popleft())
+        self._rows.append(row)
+        self.stats["appended"] += 1
+        if len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+
+    def _overflow(self, row):
+        if self.spill_path:
+            try:
+                with open(self.spill_path, "a", encoding="utf-8") as spill:
+                    spill.write(json.dumps(row) + "\n")
+                self.stats["spilled"] += 1
+                return
+            except OSError as e:
+                logger.error(f"Error spilling conversation row: {e}")
+        self.stats["dropped"] += 1
+
+    def _restore_spill(self):
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        try:
+            with open(self.spill_path, encoding="utf-8") as spill:
+                rows = [json.loads(line) for line in spill if line.strip()]
+            os.remove(self.spill_path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error restoring spilled conversations: {e}")
+            return
+        logger.info(f"Re-queued {len(rows)} spilled conversation rows")
+        for row in rows:
+            self.append(row)
+
+    async def _insert(self, batch, settled):
+        """Insert a batch, halving it on rejection until the rejected rows are isolated and dropped.
+
+        Rows that were saved or dropped are added to ``settled``; a transient
+        error is raised as is.
+        """
+        try:
+            await self.repository.insert_conversations(batch)
+        except Exception as e:
+            if not is_rejected(e):
+                raise
+            if len(batch) == 1:
+                logger.warning(f"Dropping a conversation row for {batch[0].get('user_phone')} the database rejected: {e}")
+                self.stats["rejected"] += 1
+                settled.extend(batch)
+                return
+            middle = len(batch) // 2
+            await self._insert(batch[:middle], settled)
+            await self._insert(batch[middle:], settled)
+            return
+        self.stats["inserts"] += 1
+        self.stats["flushed"] += len(batch)
+        settled.extend(batch)
+
+    async def flush(self):
+        """Insert everything buffered so far in batches; return False on failure."""
+        while self._rows:
+            batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+            settled = []
+            try:
+                await self._insert(batch, settled)
+            except Exception as e:
+                logger.error(f"Error saving {len(batch)} conversations: {e}")
+                self.stats["failures"] += 1
+                # Put the unsaved rows back in order; anything over the backlog limit overflows
+                done = {id(row) for row in settled}
+                self._rows.extendleft(reversed([row for row in batch if id(row) not in done]))
+                while len(self._rows) > self.max_backlog:
+                    self._overflow(self._rows.popleft())
+                return False
+        return True
+
+    async def _run(self):
+        backoff = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if await self.flush():
+                backoff = self.flush_interval
+            else:
+                backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+
+    def start(self):
+        """Start the background flusher on the running event loop."""
+        if self._task is None:
+            self._restore_spill()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop the flusher and write out whatever is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if not await self.flush():
+            while self._rows:
+                self._overflow(self._rows.popleft())
+        logger.info(f"Conversation log stopped: {self.stats}")
+
+
+conversation_log = ConversationLog(repository)
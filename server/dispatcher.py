@@ -0,0 +1,180 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from telegram.error import RetryAfter
+from metrics import TELEGRAM_SEND_SECONDS, TELEGRAM_SENDS
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages/second per bot and 1 message/second per chat
+GLOBAL_SENDS_PER_SECOND = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+PER_CHAT_SENDS_PER_SECOND = float(os.getenv("TELEGRAM_PER_CHAT_RATE", "1"))
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "20"))
+MAX_SEND_ATTEMPTS = 3
+
+
+class TokenBucket:
+    """Async token bucket that can be paused when Telegram asks us to back off."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Hold every acquirer for at least the given number of seconds."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TelegramRateLimiter:
+    """Applies Telegram's global and per-chat send limits to outgoing messages."""
+
+    def __init__(self, global_rate=GLOBAL_SENDS_PER_SECOND, per_chat_rate=PER_CHAT_SENDS_PER_SECOND):
+        self.global_rate = global_rate
+        self._global = TokenBucket(global_rate)
+        self._chat_interval = 1 / per_chat_rate
+        self._next_chat_send = {}
+        self._chat_locks = {}
+
+    def share_global_rate(self, processes):
+        """Limit this process to its share of the bot's send rate when several send for the same token."""
+        rate = self.global_rate / max(1, processes)
+        if rate != self._global.rate:
+            self._global.rate = self._global.capacity = rate
+            self._global._tokens = min(self._global._tokens, rate)
+            logger.info(f"Telegram send rate set to {rate:.1f}/s, shared by {processes} processes")
+
+    def _prune(self, now):
+        # Forget chats that have been idle long enough to be unconstrained again
+        if len(self._next_chat_send) > 10000:
+            for chat_id in [c for c, t in self._next_chat_send.items() if t < now and not self._chat_locks[c].locked()]:
+                del self._next_chat_send[chat_id]
+                del self._chat_locks[chat_id]
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        self._prune(now)
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            wait = self._next_chat_send.get(chat_id, 0.0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._global.acquire()
+            self._next_chat_send[chat_id] = time.monotonic() + self._chat_interval
+
+    async def send(self, chat_id, send_func, /, *args, **kwargs):
+        """Call a Bot send method under the rate limits, honouring RetryAfter."""
+        started = time.perf_counter()
+        try:
+            result = await self._send(chat_id, send_func, *args, **kwargs)
+        except Exception:
+            TELEGRAM_SENDS.inc(result="failed")
+            raise
+        finally:
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started)
+        TELEGRAM_SENDS.inc(result="sent")
+        return result
+
+    async def _send(self, chat_id, send_func, /, *args, **kwargs):
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            await self.acquire(chat_id)
+            try:
+                return await send_func(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                logger.warning(f"Telegram flood control: retrying chat {chat_id} in {seconds}s (attempt {attempt + 1})")
+                self._global.pause(seconds)
+                if attempt == MAX_SEND_ATTEMPTS - 1:
+                    raise
+
+
+class DispatchStats:
+    """Per-tick dispatch outcome and completion latency."""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.latencies = []
+        self.lateness = []  # Seconds from each sent reminder's slot, when the caller records it
+        self.elapsed = 0.0
+
+    def merge(self, other):
+        """Add another batch's outcome to this one."""
+        self.sent += other.sent
+        self.failed += other.failed
+        self.latencies.extend(other.latencies)
+        self.lateness.extend(other.lateness)
+        self.elapsed += other.elapsed
+
+    def percentile(self, pct):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def summary(self):
+        summary = (
+            f"{self.sent} sent, {self.failed} failed in {self.elapsed:.2f}s "
+            f"(p50 {self.percentile(50):.2f}s, p95 {self.percentile(95):.2f}s, max {max(self.latencies, default=0.0):.2f}s)"
+        )
+        if self.lateness:
+            summary += f", lateness max {max(self.lateness):.1f}s after the slot"
+        return summary
+
+
+async def dispatch(jobs, handle, workers=DISPATCH_WORKERS):
+    """Run ``handle(job)`` for every job on a bounded pool of asyncio workers.
+
+    ``handle`` returns True on success. Latencies are measured from the start
+    of the dispatch to each job's completion.
+    """
+    stats = DispatchStats()
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    started = time.monotonic()
+
+    async def worker():
+        while True:
+            try:
+                job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                ok = await handle(job)
+            except Exception as e:
+                logger.error(f"Dispatch job failed: {e}")
+                ok = False
+            stats.latencies.append(time.monotonic() - started)
+            if ok:
+                stats.sent += 1
+            else:
+                stats.failed += 1
+
+    await asyncio.gather(*(worker() for _ in range(min(workers, queue.qsize()))))
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+rate_limiter = TelegramRateLimiter()
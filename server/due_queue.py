@@ -0,0 +1,248 @@
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+DUE_WINDOW_MINUTES = 1  # Fire entries within ±1 minute of their slot
+
+# Minutes between occurrences for each schedule frequency
+FREQUENCY_INTERVALS = {
+    "daily": MINUTES_PER_DAY,
+    "every6hours": 6 * 60,
+}
+
+
+def slot_of(time_str):
+    """Convert an 'HH:MM' string to its minute-of-day slot."""
+    hours, minutes = str(time_str).strip().split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"invalid time {time_str!r}")
+    return hours * 60 + minutes
+
+
+def minute_of_day(now):
+    """Return the minute-of-day slot a datetime falls into."""
+    return now.hour * 60 + now.minute
+
+
+def anchor_slot(row):
+    """The slot a schedule row is anchored at, from its generated ``slot`` column or its time."""
+    return row["slot"] if row.get("slot") is not None else slot_of(row["time"])
+
+
+def occurrence_slots(frequency, slot):
+    """Expand a schedule's anchor slot into every slot it fires at each day."""
+    interval = FREQUENCY_INTERVALS.get(frequency or "daily", MINUTES_PER_DAY)
+    return sorted({(slot + offset) % MINUTES_PER_DAY for offset in range(0, MINUTES_PER_DAY, interval)})
+
+
+def occurrence_at(now, slot):
+    """Return the occurrence of a minute-of-day slot closest to now."""
+    occurrence = now.replace(hour=slot // 60, minute=slot % 60, second=0, microsecond=0)
+    if occurrence - now > timedelta(hours=12):
+        occurrence -= timedelta(days=1)
+    elif now - occurrence > timedelta(hours=12):
+        occurrence += timedelta(days=1)
+    return occurrence
+
+
+def shard_hash(user_phone):
+    """Stable hash of a user, the same in every process and as the ``shard_hash`` column."""
+    return int(hashlib.md5(str(user_phone).encode()).hexdigest()[:8], 16)
+
+
+def shard_of(user_phone, shard_count):
+    """Shard number a user falls into."""
+    return shard_hash(user_phone) % shard_count
+
+
+def parse_last_sent(value):
+    """Parse the last_sent_at column, which holds a naive local timestamp."""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+
+class DueQueue:
+    """Minute-bucketed timing wheel of recurring medications and reminders.
+
+    Entries are keyed by ``(kind, id)`` where kind is ``"medication"`` or
+    ``"reminder"`` and are indexed under every slot their frequency fires at.
+    A tick only looks at the buckets around the current minute, so its cost
+    scales with the entries due then rather than with every schedule.
+
+    Delivery state is kept per occurrence in each row's ``last_sent_at``: an
+    entry is due at an occurrence it has not been sent for yet, so recurring
+    schedules need no daily reset.
+
+    In sharded mode ``set_shards`` restricts the queue to users whose
+    ``shard_of`` falls in the shards this process owns; other rows are ignored.
+    Once loaded, the per-user index is complete for owned users and
+    ``user_entries`` can answer schedule lookups without the database.
+    """
+
+    def __init__(self):
+        self._wheel = [{} for _ in range(MINUTES_PER_DAY)]
+        self._slots = {}
+        self._by_user = {}
+        self._in_flight = set()
+        self.shards = None  # None means every user
+        self.shard_count = None
+        self.loaded = False  # Only rows added since startup are indexed until the first load
+
+    def __len__(self):
+        return len(self._slots)
+
+    def set_shards(self, shards, shard_count):
+        """Limit the queue to the given shards; return True if ownership changed."""
+        shards = frozenset(shards)
+        if shards == self.shards and shard_count == self.shard_count:
+            return False
+        self.shards, self.shard_count = shards, shard_count
+        self.loaded = False  # Newly owned users are missing until the next load
+        return True
+
+    def owns(self, user_phone):
+        return self.shards is None or shard_of(user_phone, self.shard_count) in self.shards
+
+    def add(self, kind, row):
+        """Index a row under its occurrence slots, replacing any previous entry."""
+        if not self.owns(row["user_phone"]):
+            self.discard(kind, row["id"])
+            return False
+        try:
+            slots = occurrence_slots(row.get("frequency"), anchor_slot(row))
+            row["last_sent_at"] = parse_last_sent(row.get("last_sent_at"))
+        except (KeyError, ValueError) as e:
+            logger.warning(f"Skipping {kind} {row.get('id')} with bad schedule {row.get('time')!r}: {e}")
+            return False
+        key = (kind, row["id"])
+        self.discard(kind, row["id"])
+        for slot in slots:
+            self._wheel[slot][key] = row
+        self._slots[key] = slots
+        self._by_user.setdefault(row["user_phone"], set()).add(key)
+        return True
+
+    def discard(self, kind, row_id):
+        """Remove a single entry if it is queued."""
+        key = (kind, row_id)
+        slots = self._slots.pop(key, None)
+        if slots is None:
+            return None
+        for slot in slots:
+            row = self._wheel[slot].pop(key)
+        keys = self._by_user.get(row["user_phone"])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[row["user_phone"]]
+        return row
+
+    def get(self, kind, row_id):
+        """Return the indexed row for an entry, or None."""
+        slots = self._slots.get((kind, row_id))
+        return self._wheel[slots[0]][(kind, row_id)] if slots else None
+
+    def user_entries(self, user_phone):
+        """A user's ``(kind, row)`` entries in time-of-day order, or None if the index may be incomplete for them."""
+        if not (self.loaded and self.owns(user_phone)):
+            return None
+        entries = [(kind, self.get(kind, row_id)) for kind, row_id in self._by_user.get(user_phone, ())]
+        return sorted(entries, key=lambda entry: (anchor_slot(entry[1]), entry[0]))
+
+    def remove_user(self, user_phone):
+        """Drop every queued entry belonging to a user (e.g. after /clear)."""
+        for kind, row_id in list(self._by_user.get(user_phone, ())):
+            self.discard(kind, row_id)
+
+    def _pending(self, now, offsets):
+        current = minute_of_day(now)
+        for offset in offsets:
+            slot = (current + offset) % MINUTES_PER_DAY
+            bucket = self._wheel[slot]
+            if not bucket:
+                continue
+            occurrence = occurrence_at(now, slot)
+            for (kind, row_id), row in list(bucket.items()):
+                if (kind, row_id, occurrence) in self._in_flight:
+                    continue
+                if row["last_sent_at"] is None or row["last_sent_at"] < occurrence:
+                    yield kind, row, occurrence
+
+    def pop_due(self, now, window=DUE_WINDOW_MINUTES):
+        """Claim every unsent occurrence within ±window minutes of now.
+
+        Returns ``(kind, row, occurrence)`` tuples. Claimed occurrences are in
+        flight until ``complete`` or ``requeue`` is called for them.
+        """
+        due = list(self._pending(now, range(-window, window + 1)))
+        for kind, row, occurrence in due:
+            self._in_flight.add((kind, row["id"], occurrence))
+        return due
+
+    def upcoming(self, now, minutes, window=DUE_WINDOW_MINUTES):
+        """Peek at occurrences due in the next few minutes after the current tick's window."""
+        return self._pending(now, range(window + 1, window + 1 + minutes))
+
+    def complete(self, kind, row, occurrence):
+        """Record a claimed occurrence as delivered."""
+        self._in_flight.discard((kind, row["id"], occurrence))
+        # A reload while the send was in flight may have replaced the indexed row
+        for target in (row, self.get(kind, row["id"])):
+            if target and (target["last_sent_at"] is None or target["last_sent_at"] < occurrence):
+                target["last_sent_at"] = occurrence
+
+    def requeue(self, kind, row, occurrence):
+        """Release a claimed occurrence so a later tick can retry it."""
+        self._in_flight.discard((kind, row["id"], occurrence))
+
+    def _add_keeping_delivery(self, row, last_sent_at):
+        # Deliveries recorded in memory may not have been written back yet
+        if self.add(row["kind"], row) and last_sent_at:
+            if row["last_sent_at"] is None or row["last_sent_at"] < last_sent_at:
+                row["last_sent_at"] = last_sent_at
+
+    def merge(self, rows):
+        """Index fresh copies of ``schedule_entries`` rows alongside the existing ones."""
+        for row in rows:
+            current = self.get(row["kind"], row["id"])
+            self._add_keeping_delivery(row, current and current["last_sent_at"])
+
+    def sync_window(self, rows, now, window=DUE_WINDOW_MINUTES):
+        """Merge every schedule due within ±window minutes of now, dropping queued ones ``rows`` lacks.
+
+        ``rows`` must be the complete result for that window, so an entry that
+        is missing from it was deleted, e.g. by /clear in another process.
+        """
+        fresh = {(row["kind"], row["id"]) for row in rows}
+        current = minute_of_day(now)
+        for offset in range(-window, window + 1):
+            for key in list(self._wheel[(current + offset) % MINUTES_PER_DAY]):
+                if key not in fresh:
+                    self.discard(*key)
+        self.merge(rows)
+
+    def replace(self, rows):
+        """Replace the index with ``schedule_entries`` rows, keeping deliveries recorded in memory."""
+        delivered = {key: row["last_sent_at"] for key, row in self._rows() if row["last_sent_at"]}
+        self._wheel = [{} for _ in range(MINUTES_PER_DAY)]
+        self._slots = {}
+        self._by_user = {}
+        for row in rows:
+            self._add_keeping_delivery(row, delivered.get((row["kind"], row["id"])))
+        self.loaded = True
+        logger.info(f"Due-queue loaded {len(rows)} schedules")
+        return len(self)
+
+    def _rows(self):
+        for key in self._slots:
+            yield key, self.get(*key)
+
+
+due_queue = DueQueue()
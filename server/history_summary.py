@@ -0,0 +1,170 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from llm import generate
+from repository import repository
+from session_cache import format_history
+
+logger = logging.getLogger(__name__)
+
+# Token budgets for the history block of each prompt type (estimated at ~4 characters per token)
+PROMPT_TOKEN_BUDGETS = {
+    "intent": int(os.getenv("INTENT_HISTORY_TOKENS", "300")),
+    "reminder": int(os.getenv("REMINDER_HISTORY_TOKENS", "150")),
+}
+SUMMARY_EVERY_TURNS = int(os.getenv("SUMMARY_EVERY_TURNS", "3"))
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "60"))
+SUMMARY_CACHE_MAX_USERS = int(os.getenv("SUMMARY_CACHE_MAX_USERS", "10000"))
+# Re-read summaries written by another process (e.g. the bot, for a separate scheduler) after this long
+SUMMARY_CACHE_TTL_SECONDS = int(os.getenv("SUMMARY_CACHE_TTL_SECONDS", "900"))
+MAX_PENDING_TURNS = 20  # Turns kept for a summary update that keeps failing
+
+
+def estimate_tokens(text):
+    """Rough token count for budgeting, without a tokenizer dependency."""
+    return len(text) // 4 + 1 if text else 0
+
+
+def truncate_tokens(text, budget):
+    """Trim text to about ``budget`` tokens, cutting at a word boundary."""
+    limit = max(budget, 0) * 4
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+def compose_history(summary, turns, prompt_type):
+    """Build a prompt's history block: the rolling summary plus the last exchange, within budget."""
+    budget = PROMPT_TOKEN_BUDGETS[prompt_type]
+    last = format_history(turns[:1]) if turns else ""
+    # The summary carries the long-lived facts, so the last exchange gets at most half the budget
+    last = truncate_tokens(last, budget // 2 if summary else budget)
+    parts = []
+    if summary:
+        parts.append(f"Summary of earlier conversation: {truncate_tokens(summary, budget - estimate_tokens(last))}")
+    if last:
+        parts.append(f"Last exchange:\n{last}")
+    return "\n".join(parts) or format_history([])
+
+
+def build_summary_prompt(summary, turns):
+    exchanges = "\n".join(f"User: {t['user_message']}\nBot: {t['bot_response']}" for t in turns)
+    return f"""
+    Update the running summary of a patient's chats with their nurse bot.
+    Current summary: {summary or "None yet."}
+    New exchanges (oldest first):
+    {exchanges}
+    Keep medically relevant facts (conditions, allergies, symptoms, medications, habits, preferences) and drop small talk.
+    Reply with the updated summary only, under {SUMMARY_MAX_WORDS} words.
+    """
+
+
+class HistorySummarizer:
+    """Per-user rolling conversation summaries, updated incrementally in the background.
+
+    Free-text turns answered by Gemini are collected as they are saved; every ``SUMMARY_EVERY_TURNS`` turns
+    a background task folds them into the user's summary with Gemini and
+    stores it in the ``conversation_summaries`` table. Summaries are cached
+    in LRU order for ``SUMMARY_CACHE_TTL_SECONDS``, and a user seen for the first time has their recent turns
+    folded in so existing history is not lost. All state is touched on the
+    event loop only; just the database reads and writes run elsewhere.
+    """
+
+    def __init__(self, repository, every_turns=SUMMARY_EVERY_TURNS, max_users=SUMMARY_CACHE_MAX_USERS):
+        self.repository = repository
+        self.every_turns = every_turns
+        self.max_users = max_users
+        self._summaries = OrderedDict()
+        self._pending = {}
+        self._noted = {}  # Turns noted since the last update, so seeded history alone never triggers one
+        self._updating = set()
+        self._tasks = set()
+        self.stats = {"updates": 0, "failures": 0}
+
+    def _remember(self, user_phone, summary):
+        self._summaries[user_phone] = (summary, time.monotonic() + SUMMARY_CACHE_TTL_SECONDS)
+        self._summaries.move_to_end(user_phone)
+        while len(self._summaries) > self.max_users:
+            self._summaries.popitem(last=False)
+
+    async def summaries(self, phones):
+        """Return summaries for many users ("" when they have none), querying only uncached ones."""
+        now = time.monotonic()
+        found = {}
+        for phone in phones:
+            cached = self._summaries.get(phone)
+            if cached and cached[1] > now:
+                found[phone] = cached[0]
+        missing = [phone for phone in phones if phone not in found]
+        if missing:
+            found.update(await self.repository.summaries(missing))
+            for phone in missing:
+                self._remember(phone, found.setdefault(phone, ""))
+        return found
+
+    async def summary(self, user_phone):
+        return (await self.summaries([user_phone]))[user_phone]
+
+    async def seed(self, user_phone, turns):
+        """Queue a user's existing turns (newest first) for their first summary if they have none yet.
+
+        Command turns are left out. The rest are folded in with the user's next
+        summary update rather than costing a Gemini call of their own.
+        """
+        turns = [turn for turn in turns if not str(turn.get("user_message") or "").startswith("/")]
+        if not turns or user_phone in self._pending or await self.summary(user_phone):
+            return
+        if user_phone not in self._pending:  # A turn may have been noted while the summary was read
+            self._pending[user_phone] = list(reversed(turns))[-MAX_PENDING_TURNS:]
+
+    def note_turn(self, user_phone, turn):
+        """Record a saved turn; schedules a summary update once enough have built up."""
+        pending = self._pending.setdefault(user_phone, [])
+        pending.append(turn)
+        del pending[:-MAX_PENDING_TURNS]
+        self._noted[user_phone] = self._noted.get(user_phone, 0) + 1
+        if self._noted[user_phone] >= self.every_turns:
+            self._schedule(user_phone)
+
+    def _schedule(self, user_phone):
+        if user_phone in self._updating:
+            return  # The running update reschedules itself if more turns arrive
+        try:
+            task = asyncio.get_running_loop().create_task(self._update(user_phone))
+        except RuntimeError:
+            return  # No loop (e.g. called from a script); the next turn will try again
+        self._updating.add(user_phone)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update(self, user_phone):
+        turns = self._pending.pop(user_phone, [])
+        noted = self._noted.pop(user_phone, 0)
+        try:
+            current = await self.summary(user_phone)
+            summary = await generate(build_summary_prompt(current, turns))
+            summary = truncate_tokens(summary, SUMMARY_MAX_WORDS * 2)
+            await self.repository.save_summary(user_phone, summary)
+            self._remember(user_phone, summary)
+            self.stats["updates"] += 1
+        except Exception as e:
+            logger.error(f"Error updating conversation summary for {user_phone}: {e}")
+            self.stats["failures"] += 1
+            # Keep the turns for the next attempt, ahead of any that arrived meanwhile
+            self._pending[user_phone] = (turns + self._pending.get(user_phone, []))[-MAX_PENDING_TURNS:]
+            self._noted[user_phone] = noted + self._noted.get(user_phone, 0)
+            return
+        finally:
+            self._updating.discard(user_phone)
+        if self._noted.get(user_phone, 0) >= self.every_turns:
+            self._schedule(user_phone)
+
+    async def stop(self):
+        """Wait for in-flight summary updates to finish."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+history_summarizer = HistorySummarizer(repository)
@@ -0,0 +1,250 @@
+import re
+from metrics import cache_result
+
+# Same slot mapping the Gemini prompt in telegram_bot.handle_message asks for
+MORNING = "08:00"
+AFTERNOON = "14:00"
+NIGHT = "20:00"
+EVERY_MEAL = f"{MORNING},{AFTERNOON},{NIGHT}"
+DEFAULT_TIME = MORNING
+
+CLOCK = r"(\d{1,2})(?:[:.](\d{2}))?\s*(am|pm|a\.m\.|p\.m\.)?"
+
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "half": None}
+
+# Leading verbs that make "<task> at <time>" a plain reminder rather than a medication
+TASK_VERBS = {
+    "drink", "eat", "walk", "go", "call", "check", "exercise", "sleep", "stretch", "meditate",
+    "wake", "run", "measure", "do", "read", "brush", "shower", "water", "feed", "pray",
+    "study", "rest", "cook", "buy", "visit", "pick", "book", "pay", "change", "clean",
+}
+
+# Words that never appear in a medication name; their presence means we leave it to Gemini
+STOPWORDS = {
+    "i", "im", "i'm", "me", "my", "you", "your", "we", "a", "an", "the", "to", "and", "or", "is", "am",
+    "are", "was", "have", "has", "had", "feel", "feeling", "going", "went", "get", "got", "want", "need",
+    "can", "should", "what", "how", "why", "when", "hi", "hello", "hey", "thanks", "thank", "please",
+    "cold", "fever", "headache", "party", "sick", "tired", "pain", "not", "no", "yes", "ok", "okay",
+    "it", "this", "that", "for", "with", "in", "on", "so", "but", "if", "today", "tomorrow", "remind",
+}
+
+# Greetings and mood words that turn "good morning" or "rough night" into small talk, not a medication
+NON_MED_WORDS = {
+    "good", "bad", "nice", "rough", "happy", "lovely", "well", "great", "sweet", "fine", "long", "hard",
+    "busy", "lazy", "late", "early", "sleepy", "restless", "awful", "terrible", "beautiful", "wonderful",
+    "peaceful", "quiet", "tough", "sad",
+}
+
+# Food, drink and their containers: "2 cups coffee daily" is a habit to talk about, not a medication
+NON_MED_ITEMS = {
+    "beer", "beers", "wine", "wines", "glass", "glasses", "cup", "cups", "mug", "mugs", "bottle", "bottles",
+    "pint", "pints", "shot", "shots", "drink", "drinks", "coffee", "coffees", "tea", "teas", "water", "juice",
+    "soda", "milk", "slice", "slices", "bowl", "bowls", "snack", "snacks",
+}
+
+MEAL_TIMES = {"breakfast": MORNING, "lunch": AFTERNOON, "dinner": NIGHT}
+
+_EVERY_MEAL = re.compile(
+    r"\b(?:(?:with|at|before|after)\s+)?(?:every|each|all)\s+meals?\b|\bwith\s+meals\b"
+    r"|\bthree\s+times\s+(?:a|per)\s+day\b|\bthrice\s+(?:a\s+day|daily)\b"
+)
+_TWICE_DAILY = re.compile(r"\btwice\s+(?:a\s+day|per\s+day|daily)\b")
+_EVERY_6_HOURS = re.compile(r"\bevery\s+(?:6|six)\s+(?:hours|hrs|hr|hour)\b|\b6\s*hourly\b")
+_AT_CLOCK = re.compile(rf"\bat\s+{CLOCK}(?=\s|$)")
+_PERIODS = (
+    (re.compile(r"\b(?:in\s+the\s+|every\s+|at\s+)?morning\b"), MORNING),
+    (re.compile(r"\b(?:in\s+the\s+|every\s+|at\s+)?(?:afternoon|noon)\b"), AFTERNOON),
+    (re.compile(r"\b(?:in\s+the\s+|every\s+|at\s+)?(?:night|evening|bedtime)\b|\btonight\b"), NIGHT),
+)
+_MEAL_TIMING = re.compile(
+    r"\b(before|after)\s+(?:(?:a|the|my|your)\s+)?(meals?|food|eating|breakfast|lunch|dinner)\b"
+)
+_DAILY = re.compile(r"\b(?:once\s+(?:a|per)\s+day|once\s+daily|every\s+day|daily|a\s+day|per\s+day)\b")
+_STRENGTH = re.compile(r"\b\d+(?:\.\d+)?\s*(?:mg|mcg|g|ml|iu)\b")
+_DOSAGE_FORM = re.compile(r"\b(?:tablets?|pills?|capsules?|caps|tabs?|dose|doses)\b")
+_FILLER = re.compile(
+    r"\b(?:once\s+(?:a|per)\s+day|once\s+daily|every\s+day|daily|a\s+day|per\s+day|tablets?|pills?"
+    r"|capsules?|caps|tabs?|of|dose|doses|at)\b"
+)
+_MED_PREFIX = re.compile(
+    r"^(?:please\s+)?(?:remind\s+me\s+to\s+take|i\s+(?:need\s+to\s+|have\s+to\s+|must\s+)?take|take)\s+"
+)
+_REMINDER_PREFIX = re.compile(r"^(?:please\s+)?remind\s+me\s+to\s+")
+_TASK_AT_CLOCK = re.compile(rf"^(?P<task>[a-z][a-z' ]*?)\s+at\s+(?P<clock>{CLOCK})$")
+_CLOCK_THEN_TASK = re.compile(rf"^at\s+(?P<clock>{CLOCK})\s*,?\s+(?P<task>[a-z][a-z' ]*)$")
+
+stats = {"hits": 0, "misses": 0}
+
+
+def hit_rate():
+    """Fraction of messages answered without a Gemini parse."""
+    total = stats["hits"] + stats["misses"]
+    return stats["hits"] / total if total else 0.0
+
+
+def parse_clock(text):
+    """Turn '4:45 pm', '9pm' or '21:00' into 'HH:MM'; None if ambiguous or invalid."""
+    match = re.fullmatch(CLOCK, text.strip())
+    if not match:
+        return None
+    hour, minute, meridiem = int(match.group(1)), int(match.group(2) or 0), match.group(3)
+    if minute > 59:
+        return None
+    if meridiem:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem.startswith("p") else 0)
+    elif not (hour >= 13 or (match.group(1).startswith("0") and len(match.group(1)) == 2) or hour == 0):
+        # '4:45' without am/pm could be morning or afternoon; let Gemini decide
+        return None
+    if hour > 23:
+        return None
+    return f"{hour:02d}:{minute:02d}"
+
+
+def normalize_time(text):
+    """Turn a stored 24-hour 'H:MM' or a clock time like '9pm' into 'HH:MM'; None if invalid."""
+    match = re.fullmatch(r"(\d{1,2}):(\d{2})", str(text).strip())
+    if match:
+        hour, minute = int(match.group(1)), int(match.group(2))
+        return f"{hour:02d}:{minute:02d}" if hour < 24 and minute < 60 else None
+    return parse_clock(str(text).lower())
+
+
+def _normalize(message):
+    text = message.lower().strip()
+    text = re.sub(r"[!?]+$|\.$", "", text).strip()
+    return re.sub(r"\s+", " ", text)
+
+
+def _parse_reminder(text, nickname):
+    explicit = _REMINDER_PREFIX.match(text)
+    if explicit and _MED_PREFIX.match(text):
+        return None
+    body = text[explicit.end():] if explicit else text
+    match = _TASK_AT_CLOCK.match(body) or _CLOCK_THEN_TASK.match(body)
+    if not match:
+        return None
+    task = match.group("task").strip()
+    if not explicit and task.split()[0] not in TASK_VERBS:
+        return None
+    time = parse_clock(match.group("clock"))
+    if not time:
+        return None
+    return {"task": task, "time": time, "confirmation": f"Is {time} okay for {task}, {nickname}?"}
+
+
+def _parse_medication(text, nickname):
+    prefixed = bool(_MED_PREFIX.match(text))
+    text = _MED_PREFIX.sub("", text)
+    frequency = "daily"
+    times = []
+    meal_timing = None
+    # A frequency phrase is one of the dosage signals a medication needs, unlike a bare time of day
+    scheduled = bool(_DAILY.search(text))
+
+    if _EVERY_6_HOURS.search(text):
+        frequency = "every6hours"
+        text = _EVERY_6_HOURS.sub(" ", text)
+        scheduled = True
+    if _EVERY_MEAL.search(text):
+        times.append(EVERY_MEAL)
+        text = _EVERY_MEAL.sub(" ", text)
+        scheduled = True
+    if _TWICE_DAILY.search(text):
+        times.append(f"{MORNING},{NIGHT}")
+        text = _TWICE_DAILY.sub(" ", text)
+        scheduled = True
+    for match in _AT_CLOCK.finditer(text):
+        clock = parse_clock(match.group(0)[2:])
+        if not clock:
+            return None
+        times.append(clock)
+    text = _AT_CLOCK.sub(" ", text)
+    for pattern, slot in _PERIODS:
+        match = pattern.search(text)
+        if match:
+            times.append(slot)
+            scheduled = scheduled or match.group(0).startswith("every")
+            text = pattern.sub(" ", text)
+    meal = _MEAL_TIMING.search(text)
+    if meal:
+        meal_timing = meal.group(1)
+        if not times and meal.group(2) in MEAL_TIMES:
+            times.append(MEAL_TIMES[meal.group(2)])
+        text = _MEAL_TIMING.sub(" ", text, count=1)
+    if len(times) > 1:
+        return None
+
+    strength = " ".join(s.replace(" ", "") for s in _STRENGTH.findall(text))
+    text = _STRENGTH.sub(" ", text)
+    dosage_form = bool(_DOSAGE_FORM.search(text))
+    text = _FILLER.sub(" ", text)
+
+    quantity = None
+    count_after_name = False  # The /help format, "Fexet night 1"
+    words = []
+    for word in text.split():
+        if word.isdigit() or word in NUMBER_WORDS:
+            value = int(word) if word.isdigit() else NUMBER_WORDS[word]
+            if quantity is not None or value is None or not 1 <= value <= 20:
+                return None
+            quantity = value
+            count_after_name = bool(words)
+        else:
+            words.append(word)
+
+    if not 1 <= len(words) <= 3:
+        return None
+    if words[0] in TASK_VERBS or any(
+        word in STOPWORDS or word in NON_MED_WORDS or word in NON_MED_ITEMS or not re.fullmatch(r"[a-z][a-z\-]*", word) for word in words
+    ):
+        return None
+    # A time of day alone ("good morning") is small talk; a medication also needs a dosage signal
+    if not (quantity or strength or meal_timing or scheduled):
+        return None
+    # A bare count ("2 beers tonight") also needs something that marks it as a medication
+    if not (strength or meal_timing or scheduled or prefixed or dosage_form or count_after_name):
+        return None
+
+    name = " ".join(word.capitalize() for word in words)
+    if strength:
+        name = f"{name} {strength}"
+    time = times[0] if times else DEFAULT_TIME
+    return {
+        "name": name,
+        "quantity": quantity or 1,
+        "meal_timing": meal_timing or "before",
+        "frequency": frequency,
+        "time": time,
+        "confirmation": f"Is {time} okay for {name}, {nickname}?",
+    }
+
+
+def parse_intent(message, nickname):
+    """Parse a medication or reminder message locally.
+
+    Returns ``{"medication": [...], "reminders": [...]}`` shaped like the JSON
+    the Gemini prompt produces, or None when the message needs the LLM.
+    """
+    segments = [_normalize(s) for s in re.split(r"[;\n]", message) if s.strip()]
+    result = {"medication": [], "reminders": []}
+    for segment in segments:
+        reminder = _parse_reminder(segment, nickname)
+        if reminder:
+            result["reminders"].append(reminder)
+            continue
+        medication = _parse_medication(segment, nickname)
+        if medication:
+            result["medication"].append(medication)
+            continue
+        stats["misses"] += 1
+        cache_result("intent_parser", False)
+        return None
+    if not segments:
+        stats["misses"] += 1
+        cache_result("intent_parser", False)
+        return None
+    stats["hits"] += 1
+    cache_result("intent_parser", True)
+    return result
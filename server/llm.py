@@ -0,0 +1,64 @@
+import os
+import random
+import asyncio
+import logging
+from dotenv import load_dotenv
+from google.generativeai import GenerativeModel, configure
+from llm_cache import LLMCache
+from metrics import GEMINI_REQUEST_SECONDS, GEMINI_ERRORS
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+configure(api_key=os.getenv("GEMINI_API_KEY"))
+gemini_model = GenerativeModel("gemini-2.0-flash")
+
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "20"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH")  # e.g. llm_cache.sqlite3 to survive restarts
+LLM_CACHE_FLUSH_SECONDS = float(os.getenv("LLM_CACHE_FLUSH_SECONDS", "5"))
+LLM_CACHE_VARIANTS = int(os.getenv("LLM_CACHE_VARIANTS", "5"))
+
+llm_cache = LLMCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS, LLM_CACHE_PATH, LLM_CACHE_FLUSH_SECONDS)
+
+# Caps in-flight Gemini calls per process so a burst can't exhaust quota or sockets
+_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+
+async def _generate(prompt):
+    async with _semaphore:
+        response = await gemini_model.generate_content_async(prompt)
+    return response.text.strip()
+
+
+async def generate(prompt, timeout=LLM_TIMEOUT_SECONDS):
+    """Generate text with Gemini without blocking the event loop.
+
+    The timeout covers both waiting for a concurrency slot and the call
+    itself; on timeout or cancellation the underlying request is cancelled.
+    """
+    try:
+        with GEMINI_REQUEST_SECONDS.time():
+            return await asyncio.wait_for(_generate(prompt), timeout)
+    except Exception:
+        GEMINI_ERRORS.inc()
+        raise
+
+
+async def generate_variant(key, prompt, variants=LLM_CACHE_VARIANTS, timeout=LLM_TIMEOUT_SECONDS):
+    """Serve a text from a pool of cached variants for interchangeable prompts.
+
+    Until the pool for ``key`` holds ``variants`` texts, each call generates a
+    new one and adds it; after that a random cached variant is returned.
+    """
+    pool = llm_cache.get(key) or []
+    if len(pool) >= variants:
+        return random.choice(pool)
+    text = await generate(prompt, timeout)
+    # Re-read in case a concurrent call grew the pool while we were waiting
+    pool = (llm_cache.peek(key) or []) + [text]
+    llm_cache.set(key, pool[-variants:])
+    return text
@@ -0,0 +1,131 @@
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from metrics import cache_result
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(*parts):
+    """Build a cache key from prompt features, ignoring case and spacing."""
+    return "|".join(re.sub(r"\s+", " ", str(part).strip().lower()) for part in parts)
+
+
+class LLMCache:
+    """Bounded LRU cache with per-entry TTL and optional SQLite persistence.
+
+    Values must be JSON-serializable and are stored encoded, so callers always
+    get a fresh copy they can mutate. The in-memory LRU is the only store that
+    lookups touch. When a path is given, the freshest entries are loaded from
+    SQLite at startup, and changes are written back by a background thread
+    every ``flush_seconds`` in one transaction, so the event loop never waits
+    on a commit. ``close`` writes out whatever is still pending.
+    """
+
+    def __init__(self, max_entries=5000, ttl=24 * 60 * 60, path=None, flush_seconds=5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_seconds = flush_seconds
+        self._entries = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        self._db = None
+        self._dirty = {}  # key -> (encoded, expires), or None for a delete
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("create table if not exists llm_cache (key text primary key, value text not null, expires real not null)")
+            self._db.execute("delete from llm_cache where expires < ?", (time.time(),))
+            self._db.commit()
+            rows = self._db.execute(
+                "select key, value, expires from llm_cache order by expires desc limit ?", (max_entries,)
+            ).fetchall()
+            for key, encoded, expires in reversed(rows):
+                self._store(key, (encoded, expires))
+            self._writer = threading.Thread(target=self._write_back, name="llm-cache", daemon=True)
+            self._writer.start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        value = self.peek(key)
+        self._stats["hits" if value is not None else "misses"] += 1
+        cache_result("llm", value is not None)
+        return value
+
+    def peek(self, key):
+        """Look up a key without counting it in the hit/miss stats."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        encoded, expires = entry
+        if expires < time.time():
+            self._stats["expirations"] += 1
+            self.delete(key)
+            return None
+        self._entries.move_to_end(key)
+        return json.loads(encoded)
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (ttl or self.ttl)
+        encoded = json.dumps(value)
+        self._store(key, (encoded, expires))
+        self._mark_dirty(key, (encoded, expires))
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+        self._mark_dirty(key, None)
+
+    def _mark_dirty(self, key, entry):
+        if self._db is not None:
+            with self._lock:
+                self._dirty[key] = entry
+
+    def _write_back(self):
+        while not self._closed.wait(self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        """Write pending changes to SQLite in one transaction; blocking, so keep it off the event loop."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        try:
+            with self._db:
+                self._db.executemany(
+                    "insert or replace into llm_cache (key, value, expires) values (?, ?, ?)",
+                    [(key, *entry) for key, entry in dirty.items() if entry is not None],
+                )
+                self._db.executemany("delete from llm_cache where key = ?", [(key,) for key, entry in dirty.items() if entry is None])
+        except sqlite3.Error as e:
+            logger.error(f"Error persisting {len(dirty)} LLM cache entries: {e}")
+
+    def close(self):
+        """Stop the writer and persist what it hasn't written yet."""
+        if self._db is None or self._closed.is_set():
+            return
+        self._closed.set()
+        self._writer.join()
+        self.flush()
+        self._db.close()
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def stats(self):
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "size": len(self._entries),
+            "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,232 @@
+import os
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the /metrics endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Fraction of per-row debug messages that are actually logged
+DEBUG_LOG_SAMPLE_RATE = float(os.getenv("DEBUG_LOG_SAMPLE_RATE", "0.01"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """Monotonic count, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        for key, value in list(self._values.items()):
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+
+class Gauge(Counter):
+    """Current value, set directly or read from a function at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, func=None):
+        super().__init__(name, help)
+        self.func = func
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def samples(self):
+        if self.func is not None:
+            self.set(self.func())
+        yield from super().samples()
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, optionally split by labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes, in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def percentile(self, pct, **labels):
+        """Upper bucket bound below which ``pct`` percent of observations fall."""
+        series = self._series.get(_label_key(labels))
+        if not series or not series["count"]:
+            return 0.0
+        target, running = series["count"] * pct / 100, 0
+        for bound, count in zip(self.buckets, series["counts"]):
+            running += count
+            if running >= target:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        for key, series in list(self._series.items()):
+            running = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                running += count
+                yield f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {running}"
+            yield f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series['count']}"
+            yield f"{self.name}_sum{_format_labels(key)} {series['sum']}"
+            yield f"{self.name}_count{_format_labels(key)} {series['count']}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, help, func=None):
+        return self._register(Gauge(name, help, func))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def render(self):
+        """Prometheus text exposition of every metric."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Shared by the bot and the scheduler
+SCHEDULER_TICK_SECONDS = registry.histogram("scheduler_tick_seconds", "Duration of a reminder tick")
+SCHEDULER_DUE_PER_TICK = registry.histogram("scheduler_due_per_tick", "Occurrences claimed per tick", COUNT_BUCKETS)
+DB_REQUEST_SECONDS = registry.histogram("db_request_seconds", "Supabase round-trip latency by table")
+DB_ERRORS = registry.counter("db_errors_total", "Failed Supabase requests by table")
+GEMINI_REQUEST_SECONDS = registry.histogram("gemini_request_seconds", "Gemini call latency, including the concurrency wait")
+GEMINI_ERRORS = registry.counter("gemini_errors_total", "Failed or timed-out Gemini calls")
+TELEGRAM_SEND_SECONDS = registry.histogram("telegram_send_seconds", "Telegram send latency, including rate-limit waits")
+TELEGRAM_SENDS = registry.counter("telegram_sends_total", "Telegram sends by result")
+CACHE_REQUESTS = registry.counter("cache_requests_total", "Cache lookups by cache and result")
+OUTBOX_EVENTS = registry.counter("outbox_events_total", "Outbox rows by event")
+REMINDER_LATENESS_SECONDS = registry.histogram(
+    "reminder_lateness_seconds", "Time from a reminder's slot to its successful send",
+    (1, 5, 15, 30, 60, 120, 300, 900, 3600),
+)
+
+
+def cache_result(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def db_execute(query, table):
+    """Execute a PostgREST query or RPC, recording its latency under ``table``."""
+    started = time.perf_counter()
+    try:
+        return query.execute()
+    except Exception:
+        DB_ERRORS.inc(table=table)
+        raise
+    finally:
+        DB_REQUEST_SECONDS.observe(time.perf_counter() - started, table=table)
+
+
+def debug_sampled(log, message, *args, rate=None):
+    """Log a per-row debug message for a random sample of calls only.
+
+    Arguments are formatted lazily, so skipped messages cost almost nothing.
+    """
+    if log.isEnabledFor(logging.DEBUG) and random.random() < (DEBUG_LOG_SAMPLE_RATE if rate is None else rate):
+        log.debug(message, *args)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would otherwise be printed to stderr
+
+
+_server = None
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serve /metrics on a background thread when a port is configured."""
+    global _server
+    if not port or _server is not None:
+        return _server
+    try:
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Could not start metrics endpoint on {host}:{port}: {e}")
+        return None
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return _server
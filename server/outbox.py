@@ -0,0 +1,232 @@
+import os
+import socket
+import random
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from telegram.error import BadRequest, Forbidden
+from repository import repository, chunked
+from dispatcher import DispatchStats
+from metrics import OUTBOX_EVENTS, REMINDER_LATENESS_SECONDS
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+OUTBOX_CLAIM_BATCH = int(os.getenv("OUTBOX_CLAIM_BATCH", "500"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# A reminder that cannot go out within this long after its slot is given up on
+OUTBOX_DEADLINE_MINUTES = int(os.getenv("OUTBOX_DEADLINE_MINUTES", "60"))
+OUTBOX_SEND_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_SEND_TIMEOUT_SECONDS", "15"))
+BASE_BACKOFF_SECONDS = 5
+MAX_BACKOFF_SECONDS = 300
+
+
+def is_permanent(error):
+    """Whether a send failed for good: the user blocked the bot or the chat is gone.
+
+    Other bad requests (e.g. a formatting problem in one text) are retried
+    until the row runs out of attempts or time.
+    """
+    return isinstance(error, Forbidden) or (isinstance(error, BadRequest) and "chat not found" in str(error).lower())
+
+
+def idempotency_key(kind, row_id, occurrence):
+    """Identify one occurrence of a schedule, so it is enqueued at most once."""
+    return f"{kind}:{row_id}:{occurrence.isoformat()}"
+
+
+def backoff_seconds(attempts):
+    """Exponential backoff with full jitter after the given number of attempts."""
+    return random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** (attempts - 1)))
+
+
+class Outbox:
+    """Durable queue of rendered reminders waiting to be sent.
+
+    The scheduler enqueues one row per due occurrence, keyed by
+    ``idempotency_key`` so a re-run tick cannot enqueue it twice. Workers
+    claim ready rows under a lease (``claim_outbox`` in
+    ``supabase_schema.sql``), send them and mark them sent; a failed send is
+    retried with exponential backoff until ``OUTBOX_MAX_ATTEMPTS`` or the
+    row's deadline, and a worker that dies mid-batch only holds its rows until
+    the lease expires. While a batch is being sent its unfinished rows have
+    their lease renewed, so a slow batch is never claimed a second time.
+    Delivery is at-least-once: a crash between sending and ``mark_sent``
+    resends that row once the lease runs out. Every query goes through
+    ``repository``, so it shares its thread pool and timeout.
+    """
+
+    def __init__(self, repository, worker_id=None, lease_seconds=OUTBOX_LEASE_SECONDS, claim_batch=OUTBOX_CLAIM_BATCH,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.repository = repository
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.claim_batch = claim_batch
+        self.max_attempts = max_attempts
+        self.stats = {"enqueued": 0, "sent": 0, "retried": 0, "dead": 0}
+        self._draining = False
+        self._rerun = False  # Set when a drain was skipped because this one was running
+
+    def _count(self, event, amount):
+        self.stats[event] += amount
+        OUTBOX_EVENTS.inc(amount, event=event)
+
+    def job(self, kind, row, occurrence, telegram_id, text, label):
+        """Build the outbox row for one occurrence."""
+        return {
+            "idempotency_key": idempotency_key(kind, row["id"], occurrence),
+            "kind": kind,
+            "schedule_id": row["id"],
+            "user_phone": row["user_phone"],
+            "telegram_id": str(telegram_id),
+            "text": text,
+            "label": label,
+            "occurrence": occurrence.isoformat(),
+            "next_attempt_at": occurrence.isoformat(),
+            "deadline": (occurrence + timedelta(minutes=OUTBOX_DEADLINE_MINUTES)).isoformat(),
+        }
+
+    def _table(self):
+        return self.repository.supabase.table("reminder_outbox")
+
+    async def enqueue(self, jobs):
+        """Insert jobs, skipping occurrences that are already in the outbox."""
+        await asyncio.gather(*(
+            self.repository.run(self._table().upsert(batch, on_conflict="idempotency_key", ignore_duplicates=True), "reminder_outbox")
+            for batch in chunked(jobs)
+        ))
+        self._count("enqueued", len(jobs))
+
+    async def claim(self, now):
+        """Lease up to ``claim_batch`` ready rows to this worker."""
+        return await self.repository.run(self.repository.supabase.rpc("claim_outbox", {
+            "p_owner": self.worker_id,
+            "p_now": now.isoformat(),
+            "p_lease_seconds": self.lease_seconds,
+            "p_limit": self.claim_batch,
+        }), "claim_outbox") or []
+
+    async def _update(self, ids, values):
+        # Only touch rows this worker still holds, one in_() filter per batch of ids
+        await asyncio.gather(*(
+            self.repository.run(self._table().update(values).in_("id", batch).eq("lease_owner", self.worker_id), "reminder_outbox")
+            for batch in chunked(ids)
+        ))
+
+    async def renew(self, ids, now):
+        """Extend this worker's lease on rows it is still sending."""
+        if ids:
+            await self._update(list(ids), {"lease_expires_at": (now + timedelta(seconds=self.lease_seconds)).isoformat()})
+
+    async def mark_sent(self, jobs, now):
+        if jobs:
+            await self._update([job["id"] for job in jobs], {
+                "status": "sent", "sent_at": now.isoformat(), "lease_owner": None, "lease_expires_at": None,
+            })
+            self._count("sent", len(jobs))
+
+    async def mark_dead(self, jobs, error):
+        if jobs:
+            await self._update([job["id"] for job in jobs], {
+                "status": "dead", "last_error": str(error)[:500], "lease_owner": None, "lease_expires_at": None,
+            })
+            self._count("dead", len(jobs))
+
+    async def mark_retry(self, jobs, now, error):
+        """Schedule failed jobs for another attempt, or give up on those out of attempts or time."""
+        retry, dead = {}, []
+        for job in jobs:
+            next_attempt = now + timedelta(seconds=backoff_seconds(job["attempts"]))
+            if job["attempts"] >= self.max_attempts or next_attempt > datetime.fromisoformat(job["deadline"]):
+                dead.append(job)
+            else:
+                # Jobs with the same attempt count share a backoff, so they go in one update
+                retry.setdefault(job["attempts"], (next_attempt, []))[1].append(job["id"])
+        for next_attempt, ids in retry.values():
+            await self._update(ids, {
+                "next_attempt_at": next_attempt.isoformat(), "last_error": str(error)[:500],
+                "lease_owner": None, "lease_expires_at": None,
+            })
+            self._count("retried", len(ids))
+        await self.mark_dead(dead, error)
+
+    async def _keep_leases(self, unfinished, now_func):
+        """Renew the lease on a batch's unsent rows until it is cancelled."""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.renew(list(unfinished), now_func())
+            except Exception as e:
+                logger.error(f"Outbox: error renewing leases on {len(unfinished)} rows: {e}")
+
+    async def drain(self, now_func, send, dispatch):
+        """Claim and send ready rows until none are left; return the combined ``DispatchStats``.
+
+        ``send(job)`` delivers one row and raises on failure; ``dispatch`` runs
+        it over a batch with the caller's worker pool. A drain that starts
+        while another one is running in this process returns at once and
+        asks the running one for another pass, so rows enqueued meanwhile are
+        claimed too. The running one stops only when a claim made after the
+        last such request comes back empty.
+        """
+        total = DispatchStats()
+        if self._draining:
+            self._rerun = True
+            return total
+        self._draining = True
+        self._rerun = False
+        try:
+            while True:
+                now = now_func()
+                jobs = await self.claim(now)
+                if not jobs:
+                    if not self._rerun:
+                        return total
+                    self._rerun = False
+                    continue
+                live, expired = [], []
+                for job in jobs:
+                    (live if datetime.fromisoformat(job["deadline"]) >= now else expired).append(job)
+                await self.mark_dead(expired, "deadline passed")
+
+                sent, failed, permanent = [], {}, {}
+                lateness = []
+                unfinished = {job["id"] for job in live}
+
+                async def handle(job):
+                    try:
+                        await asyncio.wait_for(send(job), OUTBOX_SEND_TIMEOUT_SECONDS)
+                    except Exception as e:
+                        if is_permanent(e):
+                            permanent.setdefault(str(e), []).append(job)
+                        else:
+                            failed.setdefault(f"{type(e).__name__}: {e}", []).append(job)
+                        return False
+                    finally:
+                        unfinished.discard(job["id"])
+                    sent.append(job)
+                    late = (now_func() - datetime.fromisoformat(job["occurrence"])).total_seconds()
+                    lateness.append(late)
+                    REMINDER_LATENESS_SECONDS.observe(late)
+                    return True
+
+                keeper = asyncio.get_running_loop().create_task(self._keep_leases(unfinished, now_func))
+                try:
+                    stats = await dispatch(live, handle)
+                finally:
+                    keeper.cancel()
+                stats.lateness.extend(lateness)
+                total.merge(stats)
+                now = now_func()
+                await self.mark_sent(sent, now)
+                for error, group in failed.items():
+                    logger.warning(f"Outbox: {len(group)} sends failed, will retry: {error}")
+                    await self.mark_retry(group, now, error)
+                for error, group in permanent.items():
+                    logger.warning(f"Outbox: {len(group)} sends failed permanently: {error}")
+                    await self.mark_dead(group, error)
+        finally:
+            self._draining = False
+
+
+outbox = Outbox(repository)
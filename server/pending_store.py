@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from metrics import cache_result
+
+logger = logging.getLogger(__name__)
+
+# memory (single process), sqlite (survives restarts) or supabase (shared by every bot replica)
+PENDING_STORE = os.getenv("PENDING_STORE", "memory").lower()
+PENDING_STORE_PATH = os.getenv("PENDING_STORE_PATH", "pending_confirmations.db")
+PENDING_TTL_SECONDS = int(os.getenv("PENDING_TTL_SECONDS", "3600"))
+# How long the sqlite/supabase stores' local cache trusts an entry; 0 turns the cache off. Off by
+# default for the shared store, where another replica may set or clear a confirmation at any time.
+SHARED_BACKENDS = ("supabase", "postgres")
+PENDING_CACHE_SECONDS = float(os.getenv("PENDING_CACHE_SECONDS", "0" if PENDING_STORE in SHARED_BACKENDS else "60"))
+PENDING_CACHE_MAX_USERS = int(os.getenv("PENDING_CACHE_MAX_USERS", "10000"))
+
+# Only what is needed to save the rows on "yes"; the confirmation strings are not kept
+MEDICATION_FIELDS = ("name", "quantity", "meal_timing", "frequency", "time")
+REMINDER_FIELDS = ("task", "time")
+
+
+def encode_pending(medications, reminders):
+    """Serialize extracted medications and reminders compactly."""
+    return json.dumps({
+        "m": [[med.get(field) for field in MEDICATION_FIELDS] for med in medications],
+        "r": [[rem.get(field) for field in REMINDER_FIELDS] for rem in reminders],
+    }, separators=(",", ":"))
+
+
+def decode_pending(encoded):
+    """Inverse of ``encode_pending``; returns ``(medications, reminders)``."""
+    data = json.loads(encoded) if isinstance(encoded, str) else encoded
+    return (
+        [dict(zip(MEDICATION_FIELDS, values)) for values in data.get("m", [])],
+        [dict(zip(REMINDER_FIELDS, values)) for values in data.get("r", [])],
+    )
+
+
+class MemoryPendingStore:
+    """Pending confirmations in process memory, expiring after ``ttl`` seconds."""
+
+    def __init__(self, ttl=PENDING_TTL_SECONDS):
+        self.ttl = ttl
+        self._entries = {}
+        self._next_sweep = time.time() + ttl
+
+    async def get(self, user_phone):
+        entry = self._entries.get(user_phone)
+        if entry is None:
+            return None
+        encoded, expires = entry
+        if expires < time.time():
+            del self._entries[user_phone]
+            return None
+        return decode_pending(encoded)
+
+    async def set(self, user_phone, medications, reminders):
+        if not medications and not reminders:
+            await self.clear(user_phone)
+            return
+        now = time.time()
+        self._entries[user_phone] = (encode_pending(medications, reminders), now + self.ttl)
+        if now >= self._next_sweep:
+            # Abandoned confirmations are never read again, so drop them periodically
+            self._entries = {phone: entry for phone, entry in self._entries.items() if entry[1] >= now}
+            self._next_sweep = now + self.ttl
+
+    async def clear(self, user_phone):
+        self._entries.pop(user_phone, None)
+
+
+class SQLitePendingStore:
+    """Pending confirmations in a local SQLite file, so they survive restarts.
+
+    Statements run on a worker thread, one at a time, so commits never block the event loop.
+    """
+
+    def __init__(self, path=PENDING_STORE_PATH, ttl=PENDING_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "create table if not exists pending_confirmations (user_phone text primary key, payload text not null, expires real not null)"
+        )
+        self._db.execute("delete from pending_confirmations where expires < ?", (time.time(),))
+        self._db.commit()
+
+    def _get(self, user_phone):
+        with self._lock:
+            return self._db.execute(
+                "select payload from pending_confirmations where user_phone = ? and expires >= ?", (user_phone, time.time())
+            ).fetchone()
+
+    def _set(self, user_phone, encoded):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "insert or replace into pending_confirmations (user_phone, payload, expires) values (?, ?, ?)",
+                (user_phone, encoded, now + self.ttl),
+            )
+            self._db.execute("delete from pending_confirmations where expires < ?", (now,))
+            self._db.commit()
+
+    def _clear(self, user_phone):
+        with self._lock:
+            self._db.execute("delete from pending_confirmations where user_phone = ?", (user_phone,))
+            self._db.commit()
+
+    async def get(self, user_phone):
+        row = await asyncio.to_thread(self._get, user_phone)
+        return decode_pending(row[0]) if row else None
+
+    async def set(self, user_phone, medications, reminders):
+        if not medications and not reminders:
+            await self.clear(user_phone)
+            return
+        await asyncio.to_thread(self._set, user_phone, encode_pending(medications, reminders))
+
+    async def clear(self, user_phone):
+        await asyncio.to_thread(self._clear, user_phone)
+
+
+class SupabasePendingStore:
+    """Pending confirmations in the Postgres ``pending_confirmations`` table, shared by all replicas."""
+
+    def __init__(self, repository, ttl=PENDING_TTL_SECONDS):
+        self.repository = repository
+        self.ttl = ttl
+        self._next_sweep = 0.0
+
+    def _table(self):
+        return self.repository.supabase.table("pending_confirmations")
+
+    async def get(self, user_phone):
+        now = datetime.now(timezone.utc).isoformat()
+        rows = await self.repository.run(
+            self._table().select("payload").eq("user_phone", user_phone).gte("expires_at", now), "pending_confirmations"
+        )
+        return decode_pending(rows[0]["payload"]) if rows else None
+
+    async def set(self, user_phone, medications, reminders):
+        if not medications and not reminders:
+            await self.clear(user_phone)
+            return
+        now = datetime.now(timezone.utc)
+        await self.repository.run(self._table().upsert({
+            "user_phone": user_phone,
+            "payload": encode_pending(medications, reminders),
+            "expires_at": (now + timedelta(seconds=self.ttl)).isoformat(),
+        }, on_conflict="user_phone"), "pending_confirmations")
+        if time.time() >= self._next_sweep:
+            self._next_sweep = time.time() + self.ttl
+            await self.repository.run(self._table().delete().lt("expires_at", now.isoformat()), "pending_confirmations")
+
+    async def clear(self, user_phone):
+        await self.repository.run(self._table().delete().eq("user_phone", user_phone), "pending_confirmations")
+
+
+class CachedPendingStore:
+    """Local cache in front of a persistent store, so most messages need no read at all.
+
+    Writes go through to the store and update the cache, including "nothing
+    pending", which is the common case. Entries are trusted for
+    ``PENDING_CACHE_SECONDS``, so only use it where this process is the only
+    writer, or where every chat is routed to the same replica.
+    """
+
+    def __init__(self, store, ttl=PENDING_CACHE_SECONDS, max_users=PENDING_CACHE_MAX_USERS):
+        self.store = store
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries = OrderedDict()
+
+    def _remember(self, user_phone, encoded):
+        self._entries[user_phone] = (encoded, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_phone)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    async def get(self, user_phone):
+        entry = self._entries.get(user_phone)
+        if entry and entry[1] > time.monotonic():
+            cache_result("pending", True)
+            return decode_pending(entry[0]) if entry[0] else None
+        cache_result("pending", False)
+        pending = await self.store.get(user_phone)
+        self._remember(user_phone, encode_pending(*pending) if pending else None)
+        return pending
+
+    async def set(self, user_phone, medications, reminders):
+        await self.store.set(user_phone, medications, reminders)
+        self._remember(user_phone, encode_pending(medications, reminders) if medications or reminders else None)
+
+    async def clear(self, user_phone):
+        await self.store.clear(user_phone)
+        self._remember(user_phone, None)
+
+
+def create_pending_store(backend=PENDING_STORE, cache_seconds=PENDING_CACHE_SECONDS):
+    """Build the store selected by ``PENDING_STORE``."""
+    def cached(store):
+        return CachedPendingStore(store, cache_seconds) if cache_seconds > 0 else store
+
+    if backend == "sqlite":
+        return cached(SQLitePendingStore())
+    if backend in SHARED_BACKENDS:
+        from repository import repository
+        return cached(SupabasePendingStore(repository))
+    if backend != "memory":
+        logger.warning(f"Unknown PENDING_STORE {backend!r}, keeping confirmations in memory")
+    return MemoryPendingStore()
+
+
+pending_store = create_pending_store()
@@ -0,0 +1,64 @@
+import random
+from llm import generate, generate_variant
+from llm_cache import cache_key
+
+NO_HISTORY = "No recent conversation history."
+
+
+def build_reminder_prompt(user_name, med_name=None, quantity=None, meal_timing=None, task=None, conversation_history=None, nickname=None):
+    """Build the Gemini prompt for a medication or task reminder."""
+    nickname = nickname or random.choice(["Baby","Love"])
+    conversation_history = conversation_history or NO_HISTORY
+    recipient = f"{nickname} (real name: {user_name})" if user_name else nickname
+    if med_name:
+        return f"""
+        Generate a loving medication reminder for {recipient} to take {quantity} {med_name} {meal_timing} their meal.
+        Use a warm, nurse-like tone with emojis (💖, 🌸, 😘).
+        Include dietary restrictions and healing advice based on the medication and conversation history:
+        {conversation_history}
+        For example:
+        - Fexet: Avoid alcohol, rest well.
+        - Moxikind: Stay hydrated, avoid dairy.
+        - Predni: Low-sodium diet, monitor blood sugar.
+        Keep it under 60 words, including a caring follow-up question.
+        """
+    return f"""
+        Generate a loving reminder for {recipient} to {task}.
+        Use a warm, nurse-like tone with emojis (💖, 🌸, 😘).
+        Include health advice based on the task and conversation history:
+        {conversation_history}
+        For example, for 'drink water', suggest hydration tips.
+        Keep it under 60 words, including a caring follow-up question.
+        """
+
+
+def fallback_reminder_text(med_name=None, quantity=None, meal_timing=None, task=None, nickname=None):
+    """Template used when no generated text is available at send time."""
+    nickname = nickname or random.choice(["Baby","Love"])
+    if med_name:
+        return (
+            f"Hey {nickname}! 💖 Time to take {quantity} {med_name} {meal_timing} your meal. 🌸 "
+            "Drink some water with it and rest well. How are you feeling right now? 😘"
+        )
+    return f"Hey {nickname}! 🌸 Just a gentle reminder to {task}. 💖 How are you doing today? 😘"
+
+
+def reminder_fields(kind, row):
+    """Map a due-queue row to the keyword arguments the builders above take."""
+    if kind == "medication":
+        return {"med_name": row["name"], "quantity": row["quantity"], "meal_timing": row["meal_timing"]}
+    return {"task": row["task"]}
+
+
+async def render_reminder_text(user_name, med_name=None, quantity=None, meal_timing=None, task=None, conversation_history=None):
+    """Generate a reminder text with Gemini.
+
+    Users without conversation history get a text from a shared pool of
+    variants per (medication, quantity, meal timing) or task instead of a
+    personalised generation.
+    """
+    if conversation_history in (None, NO_HISTORY):
+        key = cache_key("reminder", med_name, quantity, meal_timing) if med_name else cache_key("task", task)
+        return await generate_variant(key, build_reminder_prompt(None, med_name, quantity, meal_timing, task))
+    prompt = build_reminder_prompt(user_name, med_name, quantity, meal_timing, task, conversation_history)
+    return await generate(prompt)
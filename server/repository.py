@@ -0,0 +1,183 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from database import supabase
+from metrics import db_execute, DB_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Queries in flight at once, i.e. threads in the repository's pool
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", "16"))
+DB_TIMEOUT_SECONDS = float(os.getenv("DB_TIMEOUT_SECONDS", "10"))
+BATCH_SIZE = 100  # Values per in_() filter or rows per insert, keeps requests small
+PAGE_SIZE = 1000  # PostgREST caps a single response at 1000 rows
+
+CONVERSATION_COLUMNS = "user_phone,user_message,bot_response,timestamp"
+SCHEDULE_TABLES = {"medication": "medications", "reminder": "reminders"}
+
+
+def is_rejected(error):
+    """Whether the database refused the request itself, e.g. a constraint violation, so retrying can't help.
+
+    PostgREST errors carry a Postgres SQLSTATE or a ``PGRST`` code; data
+    exceptions (22), integrity violations (23), undefined objects (42) and
+    PostgREST's own request errors (PGRST1, PGRST2) are rejections, while
+    timeouts, dropped connections and overloaded servers are not.
+    """
+    code = str(getattr(error, "code", None) or "")
+    return code[:2] in ("22", "23", "42") or code.startswith(("PGRST1", "PGRST2"))
+
+
+def chunked(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Repository:
+    """Async access to users, schedules and conversations through one shared Supabase client.
+
+    The client keeps a pool of keep-alive connections, so the bot and the
+    scheduler reuse them instead of reconnecting. Queries run on a dedicated
+    pool of ``max_concurrency`` threads, which keeps handlers off the event
+    loop's critical path and caps how many requests a burst can put in
+    flight. Each call gives up after ``timeout`` seconds; the query itself
+    still finishes in its thread.
+    """
+
+    def __init__(self, supabase, max_concurrency=DB_MAX_CONCURRENCY, timeout=DB_TIMEOUT_SECONDS):
+        self.supabase = supabase
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="db")
+
+    async def run(self, query, table, timeout=None):
+        """Execute a query builder without blocking the event loop; return its rows."""
+        future = asyncio.get_running_loop().run_in_executor(self._executor, db_execute, query, table)
+        try:
+            return (await asyncio.wait_for(future, timeout or self.timeout)).data
+        except asyncio.TimeoutError:
+            DB_ERRORS.inc(table=table)
+            raise
+
+    async def _batched(self, make_query, table, values, timeout=None):
+        """Run one query per batch of values concurrently and concatenate the rows."""
+        pages = await asyncio.gather(*(self.run(make_query(batch), table, timeout) for batch in chunked(values)))
+        return [row for page in pages for row in page or ()]
+
+    # Users
+
+    async def user_by_telegram_id(self, telegram_id):
+        rows = await self.run(self.supabase.table("users").select("*").eq("telegram_id", telegram_id), "users")
+        return rows[0] if rows else None
+
+    async def create_user(self, user):
+        return await self.run(self.supabase.table("users").insert(user), "users")
+
+    async def users_by_phone(self, phones):
+        """Map phone to user for many phones, one in_() query per batch."""
+        rows = await self._batched(lambda batch: self.supabase.table("users").select("*").in_("phone", batch), "users", list(phones))
+        return {user["phone"]: user for user in rows}
+
+    # Medications and reminders
+
+    async def insert_schedules(self, kind, rows):
+        """Insert medications or reminders in bulk; returns the stored rows with their ids."""
+        table = SCHEDULE_TABLES[kind]
+        return await self._batched(lambda batch: self.supabase.table(table).insert(batch), table, rows)
+
+    async def delete_schedules(self, user_phone):
+        """Remove every medication and reminder of a user."""
+        await asyncio.gather(*(
+            self.run(self.supabase.table(table).delete().eq("user_phone", user_phone), table)
+            for table in SCHEDULE_TABLES.values()
+        ))
+
+    async def schedule_entries(self, user_phone):
+        """A user's medications and reminders in time-of-day order, from one indexed query."""
+        return await self.run(
+            self.supabase.table("schedule_entries").select("*").eq("user_phone", user_phone).order("slot"), "schedule_entries"
+        )
+
+    async def _paged(self, function, params, cursor=lambda row: {"p_after": row["id"]}):
+        """Call a keyset-paged RPC until a short page, so PostgREST's row cap never truncates the result.
+
+        ``cursor`` maps the last row of a page to the parameters that ask for the rows after it.
+        """
+        rows, after = [], {}
+        while True:
+            page = await self.run(self.supabase.rpc(function, {**params, **after, "p_limit": PAGE_SIZE}), function) or []
+            rows.extend(page)
+            if len(page) < PAGE_SIZE:
+                return rows
+            after = cursor(page[-1])
+
+    async def schedules(self, shards=None, shard_count=None):
+        """Every schedule with its recipient, or only those in the given shards, paged by id."""
+        return await self._paged("schedules_in_shards", {
+            "p_shards": sorted(shards) if shards is not None else None,
+            "p_shard_count": shard_count,
+        })
+
+    async def due_in_minute(self, slot, window, shards=None, shard_count=None):
+        """Schedules due around a minute of the day, joined with their recipient, optionally for some shards only."""
+        return await self._paged("due_in_minute", {
+            "p_slot": slot,
+            "p_window": window,
+            "p_shards": sorted(shards) if shards is not None else None,
+            "p_shard_count": shard_count,
+        }, cursor=lambda row: {"p_after_slot": row["slot"], "p_after": row["id"]})
+
+    async def mark_sent(self, kind, ids, occurrence):
+        """Record ``occurrence`` as the last delivery of many schedules."""
+        table = SCHEDULE_TABLES[kind]
+        values = {"last_sent_at": occurrence.isoformat(), "sent": True}
+        await self._batched(lambda batch: self.supabase.table(table).update(values).in_("id", batch), table, list(ids))
+
+    # Conversations
+
+    async def insert_conversations(self, rows):
+        await self.run(self.supabase.table("conversations").insert(rows), "conversations")
+
+    async def recent_conversations(self, user_phone, limit):
+        """A user's newest turns, newest first."""
+        return await self.run(
+            self.supabase.table("conversations").select(CONVERSATION_COLUMNS).eq("user_phone", user_phone)
+            .order("timestamp", desc=True).limit(limit), "conversations"
+        )
+
+    async def recent_conversations_for(self, phones, per_user):
+        """Map phone to its newest ``per_user`` turns for many users, one RPC per batch of phones.
+
+        The ``recent_conversations`` function limits per user on the server,
+        so chatty users can't crowd anyone else out of a batch.
+        """
+        grouped = {phone: [] for phone in phones}
+        rows = await self._batched(
+            lambda batch: self.supabase.rpc("recent_conversations", {"p_phones": batch, "p_per_user": per_user}),
+            "recent_conversations", list(phones),
+        )
+        for row in rows:
+            grouped[row["user_phone"]].append(row)
+        return grouped
+
+    async def summaries(self, phones):
+        """Map phone to stored conversation summary, for the phones that have one."""
+        rows = await self._batched(
+            lambda batch: self.supabase.table("conversation_summaries").select("user_phone,summary").in_("user_phone", batch),
+            "conversation_summaries", list(phones),
+        )
+        return {row["user_phone"]: row["summary"] for row in rows}
+
+    async def save_summary(self, user_phone, summary):
+        await self.run(self.supabase.table("conversation_summaries").upsert({
+            "user_phone": user_phone,
+            "summary": summary,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }, on_conflict="user_phone"), "conversation_summaries")
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+repository = Repository(supabase)
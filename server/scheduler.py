@@ -4,161 +4,298 @@ import random
 from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from telegram import Bot
-from database import supabase
+from telegram.error import BadRequest
+from due_queue import due_queue, minute_of_day, DUE_WINDOW_MINUTES
+from repository import repository
+from session_cache import session_cache
+from history_summary import history_summarizer, compose_history
+from dispatcher import dispatch, rate_limiter
+from outbox import outbox
+from shards import shard_lease
 from dotenv import load_dotenv
-from google.generativeai import GenerativeModel, configure
+from llm import llm_cache
+from metrics import (
+    registry, debug_sampled, cache_result, start_metrics_server, SCHEDULER_TICK_SECONDS,
+    SCHEDULER_DUE_PER_TICK,
+)
+from reminder_texts import render_reminder_text, fallback_reminder_text, reminder_fields
 import aiohttp
+import logging
 
 load_dotenv()
 
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-configure(api_key=os.getenv("GEMINI_API_KEY"))
-gemini_model = GenerativeModel("gemini-2.0-flash")
+# Safety-net reload for schedules written by a bot running in a separate process
+DUE_QUEUE_RESYNC_MINUTES = int(os.getenv("DUE_QUEUE_RESYNC_MINUTES", "5"))
+# How far ahead reminder texts are generated, so Gemini stays off the delivery path
+PRERENDER_MINUTES = int(os.getenv("PRERENDER_MINUTES", "15"))
+PRERENDER_RETENTION_MINUTES = 60  # Keep texts for occurrences that could not be enqueued yet
+
+# Run as one of several workers, each owning a share of users through DB leases
+SCHEDULER_SHARDED = os.getenv("SCHEDULER_SHARDED", "false").lower() == "true"
+# How often outbox retries are picked up between minute ticks
+OUTBOX_POLL_SECONDS = int(os.getenv("OUTBOX_POLL_SECONDS", "15"))
 
 # Initialize Telegram bot
 if TELEGRAM_BOT_TOKEN:
     bot = Bot(token=TELEGRAM_BOT_TOKEN)
-    print(f"Telegram bot initialized with token: {TELEGRAM_BOT_TOKEN[:10]}...")
+    logger.info(f"Telegram bot initialized with token: {TELEGRAM_BOT_TOKEN[:10]}...")
 else:
     bot = None
-    print("WARNING: TELEGRAM_BOT_TOKEN not found")
+    logger.warning("TELEGRAM_BOT_TOKEN not found")
 
 # Global aiohttp session
 session = None
 
-async def get_conversation_history(user_phone):
-    """Retrieve recent conversation history."""
+SKIPPED = registry.counter("scheduler_skipped_total", "Due occurrences that could not be enqueued, by reason")
+
+# (kind, id) -> generated text plus the recipient it was rendered for
+prerendered = {}
+
+async def resolve_users(rows):
+    """Map user_phone to user for schedule rows, querying only for rows loaded without their recipient."""
+    users = {
+        row["user_phone"]: {"name": row["user_name"], "telegram_id": row["telegram_id"]}
+        for row in rows if "telegram_id" in row
+    }
+    missing = sorted({row["user_phone"] for row in rows if row["user_phone"] not in users})
+    if missing:
+        users.update(await repository.users_by_phone(missing))
+    return users
+
+async def fetch_recent_histories(phones, per_user=1):
+    """Build reminder-prompt histories for many users with bulk queries.
+
+    Each history is the user's rolling summary plus their last exchange,
+    trimmed to the reminder token budget. Turns already in the bot's session
+    cache (when the scheduler runs in the bot process) are served from
+    memory; the rest are fetched in batches.
+    """
+    summaries = await history_summarizer.summaries(phones)
+    histories = {}
+    for phone in phones:
+        cached = session_cache.history(phone)
+        if cached is not None:
+            histories[phone] = compose_history(summaries[phone], cached, "reminder")
+    grouped = await repository.recent_conversations_for([phone for phone in phones if phone not in histories], per_user)
+    histories.update({phone: compose_history(summaries[phone], turns, "reminder") for phone, turns in grouped.items()})
+    return histories
+
+async def deliver(job):
+    """Send one outbox row; raises so the outbox can retry or give up on it."""
+    if not bot:
+        raise RuntimeError("Bot not initialized - check TELEGRAM_BOT_TOKEN")
+    try:
+        await rate_limiter.send(job["telegram_id"], bot.send_message, chat_id=job["telegram_id"], text=job["text"], parse_mode='Markdown')
+    except BadRequest as e:
+        if "can't parse entities" not in str(e).lower():
+            raise
+        # A stray '*' or '_' in generated text breaks Markdown; the words still matter, so send them plain
+        await rate_limiter.send(job["telegram_id"], bot.send_message, chat_id=job["telegram_id"], text=job["text"])
+    debug_sampled(logger, "✅ Telegram message sent to %s: %s", job["telegram_id"], job["label"])
+
+async def drain_outbox():
+    """Send every ready outbox row, including retries left over from earlier ticks."""
     try:
-        conversations = supabase.table("conversations").select("*").eq("user_phone", user_phone).order("timestamp", desc=True).limit(5).execute().data
-        history = "\n".join([f"User: {c['user_message']}\nBot: {c['bot_response']}" for c in conversations])
-        return history or "No recent conversation history."
+        stats = await outbox.drain(datetime.now, deliver, dispatch)
+        if stats.sent or stats.failed:
+            logger.info(f"📬 Outbox: {stats.summary()}, totals {outbox.stats}")
+        late = sum(1 for seconds in stats.lateness if seconds > 60)
+        if late:
+            logger.warning(f"⚠️ {late} reminders went out more than a minute after their slot")
     except Exception as e:
-        print(f"Error retrieving conversation history: {e}")
-        return "No recent conversation history."
+        logger.error(f"❌ Error draining outbox: {e}")
 
-async def send_telegram_reminder(user_name, user_telegram_id, med_name=None, quantity=None, meal_timing=None, task=None, user_phone=None):
-    if not bot:
-        print("ERROR: Bot not initialized - check TELEGRAM_BOT_TOKEN")
-        return False
-    
-    nickname = random.choice(["Baby","Love"])
-    conversation_history = await get_conversation_history(user_phone)
-    if med_name:
-        prompt = f"""
-        Generate a loving medication reminder for {nickname} (real name: {user_name}) to take {quantity} {med_name} {meal_timing} their meal.
-        Use a warm, nurse-like tone with emojis (💖, 🌸, 😘).
-        Include dietary restrictions and healing advice based on the medication and conversation history:
-        {conversation_history}
-        For example:
-        - Fexet: Avoid alcohol, rest well.
-        - Moxikind: Stay hydrated, avoid dairy.
-        - Predni: Low-sodium diet, monitor blood sugar.
-        Keep it under 60 words, including a caring follow-up question.
-        """
-    else:
-        prompt = f"""
-        Generate a loving reminder for {nickname} (real name: {user_name}) to {task}.
-        Use a warm, nurse-like tone with emojis (💖, 🌸, 😘).
-        Include health advice based on the task and conversation history:
-        {conversation_history}
-        For example, for 'drink water', suggest hydration tips.
-        Keep it under 60 words, including a caring follow-up question.
-        """
-    global session
+async def prerender_upcoming():
+    """Generate and store reminder texts for entries due in the next few minutes."""
     try:
-        response = gemini_model.generate_content(prompt)
-        message = response.text.strip()
-        await bot.send_message(chat_id=user_telegram_id, text=message, parse_mode='Markdown')
-        print(f"✅ Telegram message sent to {user_telegram_id}: {med_name or task}")
-        return True
+        now = datetime.now()
+        cutoff = now - timedelta(minutes=PRERENDER_RETENTION_MINUTES)
+        for key in [key for key in prerendered if key[2] < cutoff]:
+            del prerendered[key]
+        upcoming = [
+            (kind, row, occurrence) for kind, row, occurrence in due_queue.upcoming(now, PRERENDER_MINUTES)
+            if (kind, row["id"], occurrence) not in prerendered
+        ]
+        if not upcoming:
+            return
+
+        users = await resolve_users([row for _, row, _ in upcoming])
+        phones = sorted({row["user_phone"] for _, row, _ in upcoming})
+        histories = await fetch_recent_histories([phone for phone in phones if users.get(phone, {}).get("telegram_id")])
+
+        async def render(job):
+            kind, row, occurrence = job
+            user_data = users.get(row["user_phone"])
+            if not user_data or not user_data.get("telegram_id"):
+                return False
+            text = await render_reminder_text(
+                user_data["name"], conversation_history=histories.get(row["user_phone"]), **reminder_fields(kind, row)
+            )
+            prerendered[(kind, row["id"], occurrence)] = {
+                "text": text,
+                "telegram_id": user_data["telegram_id"],
+                "name": user_data["name"],
+            }
+            return True
+
+        stats = await dispatch(upcoming, render)
+        logger.info(f"📝 Pre-rendered {stats.sent} of {len(upcoming)} upcoming reminders: {stats.summary()}")
+        logger.info(f"🗃️ LLM cache: {llm_cache.stats()}")
     except Exception as e:
-        print(f"❌ Error sending Telegram message: {e}")
-        return False
+        logger.error(f"❌ Error in prerender_upcoming: {e}")
+
+def outbox_job(kind, row, occurrence, user_data):
+    """Build the outbox row for a due occurrence, or None if its user can't be messaged."""
+    rendered = prerendered.get((kind, row["id"], occurrence))
+    cache_result("prerendered", rendered is not None)
+    if rendered:
+        telegram_id = rendered["telegram_id"]
+        message = rendered["text"]
+    else:
+        if not user_data:
+            SKIPPED.inc(reason="unknown_user")
+            debug_sampled(logger, "❌ User not found for phone: %s", row["user_phone"])
+            return None
+        telegram_id = user_data.get("telegram_id")
+        if not telegram_id:
+            SKIPPED.inc(reason="no_telegram_id")
+            debug_sampled(logger, "❌ Telegram ID not found for user: %s", user_data["name"])
+            return None
+        # Never call Gemini on the delivery path; fall back to a template instead
+        debug_sampled(logger, "📄 No pre-rendered text for %s %s, using template", kind, row["id"])
+        message = fallback_reminder_text(**reminder_fields(kind, row))
+    label = row["name"] if kind == "medication" else row["task"]
+    return outbox.job(kind, row, occurrence, telegram_id, message, label)
 
 async def check_and_send_reminders():
+    with SCHEDULER_TICK_SECONDS.time():
+        await _check_and_send_reminders()
+
+async def _check_and_send_reminders():
     try:
         now = datetime.now()
         now_str = now.strftime("%H:%M")
-        print(f"🔍 Checking reminders at {now_str}")
-        
-        # Check medications
-        meds = supabase.table("medications").select("*").eq("sent", False).execute().data
-        print(f"📋 Found {len(meds)} unsent medications")
-        for m in meds:
-            med_time = datetime.strptime(m["time"], "%H:%M")
-            med_datetime = now.replace(hour=med_time.hour, minute=med_time.minute, second=0, microsecond=0)
-            time_diff = abs((now - med_datetime).total_seconds()) / 60
-            print(f"⏰ Medication {m['name']} scheduled for {m['time']}, current time: {now_str}, time diff: {time_diff:.2f} minutes")
-            if time_diff <= 1:  # Within ±1 minute
-                print(f"🎯 Time match! Processing medication: {m['name']}")
-                user = supabase.table("users").select("*").eq("phone", m["user_phone"]).execute().data
-                if user:
-                    user_data = user[0]
-                    telegram_id = user_data.get("telegram_id")
-                    if telegram_id:
-                        print(f"👤 Telegram user found: {user_data['name']} (ID: {telegram_id})")
-                        success = await send_telegram_reminder(
-                            user_data["name"], telegram_id, m["name"], m["quantity"], m["meal_timing"], None, m["user_phone"]
-                        )
-                        if success:
-                            supabase.table("medications").update({"sent": True}).eq("id", m["id"]).execute()
-                            print(f"✅ Marked medication {m['id']} as sent")
-                        else:
-                            print(f"❌ Failed to send Telegram medication reminder")
-                    else:
-                        print(f"❌ Telegram ID not found for user: {user_data['name']}")
-                else:
-                    print(f"❌ User not found for phone: {m['user_phone']}")
-            else:
-                print(f"⏳ Not time yet for {m['name']} (scheduled: {m['time']}, current: {now_str})")
-        
-        # Check reminders
-        reminders = supabase.table("reminders").select("*").eq("sent", False).execute().data
-        print(f"📋 Found {len(reminders)} unsent reminders")
-        for r in reminders:
-            rem_time = datetime.strptime(r["time"], "%H:%M")
-            rem_datetime = now.replace(hour=rem_time.hour, minute=rem_time.minute, second=0, microsecond=0)
-            time_diff = abs((now - rem_datetime).total_seconds()) / 60
-            print(f"⏰ Reminder {r['task']} scheduled for {r['time']}, current time: {now_str}, time diff: {time_diff:.2f} minutes")
-            if time_diff <= 1:  # Within ±1 minute
-                print(f"🎯 Time match! Processing reminder: {r['task']}")
-                user = supabase.table("users").select("*").eq("phone", r["user_phone"]).execute().data
-                if user:
-                    user_data = user[0]
-                    telegram_id = user_data.get("telegram_id")
-                    if telegram_id:
-                        print(f"👤 Telegram user found: {user_data['name']} (ID: {telegram_id})")
-                        success = await send_telegram_reminder(
-                            user_data["name"], telegram_id, None, None, None, r["task"], r["user_phone"]
-                        )
-                        if success:
-                            supabase.table("reminders").update({"sent": True}).eq("id", r["id"]).execute()
-                            print(f"✅ Marked reminder {r['id']} as sent")
-                        else:
-                            print(f"❌ Failed to send Telegram reminder")
-                    else:
-                        print(f"❌ Telegram ID not found for user: {user_data['name']}")
-                else:
-                    print(f"❌ User not found for phone: {r['user_phone']}")
+        try:
+            # One indexed query; catches schedules another process added or deleted since the last reload
+            due_queue.sync_window(await repository.due_in_minute(
+                minute_of_day(now), DUE_WINDOW_MINUTES, due_queue.shards, due_queue.shard_count
+            ), now)
+        except Exception as e:
+            logger.error(f"❌ Error fetching due schedules, using the in-memory queue: {e}")
+        due = due_queue.pop_due(now)
+        SCHEDULER_DUE_PER_TICK.observe(len(due))
+        logger.info(f"🔍 Checking reminders at {now_str}: {len(due)} due of {len(due_queue)} schedules")
+        if due:
+            await enqueue_due(due)
+        # Also picks up retries and rows left behind by a worker whose lease expired
+        await drain_outbox()
+    except Exception as e:
+        logger.error(f"❌ Error in check_and_send_reminders: {e}")
+
+async def enqueue_due(due):
+    """Hand due occurrences to the outbox; the queue only moves on once they are stored."""
+    try:
+        # Only rows without a pre-rendered text still need their user resolved
+        users = await resolve_users([
+            row for kind, row, occurrence in due if (kind, row["id"], occurrence) not in prerendered
+        ])
+        jobs, enqueued = [], []
+        for kind, row, occurrence in due:
+            job = outbox_job(kind, row, occurrence, users.get(row["user_phone"]))
+            if job:
+                jobs.append(job)
+                enqueued.append((kind, row, occurrence))
             else:
-                print(f"⏳ Not time yet for {r['task']} (scheduled: {r['time']}, current: {now_str})")
-                
+                # Leave it pending; the next tick retries while the slot is still within ±1 minute.
+                due_queue.requeue(kind, row, occurrence)
+        await outbox.enqueue(jobs)
+    except Exception:
+        for kind, row, occurrence in due:
+            due_queue.requeue(kind, row, occurrence)
+        raise
+    for kind, row, occurrence in enqueued:
+        due_queue.complete(kind, row, occurrence)
+        prerendered.pop((kind, row["id"], occurrence), None)
+    await record_deliveries([(kind, row["id"], occurrence) for kind, row, occurrence in enqueued])
+    logger.info(f"📮 Enqueued {len(jobs)} of {len(due)} due reminders")
+
+async def record_deliveries(delivered):
+    """Persist last_sent_at for occurrences handed to the outbox, one update per table and occurrence."""
+    grouped = {}
+    for kind, row_id, occurrence in delivered:
+        grouped.setdefault((kind, occurrence), []).append(row_id)
+    for (kind, occurrence), ids in grouped.items():
+        try:
+            await repository.mark_sent(kind, ids, occurrence)
+            logger.debug(f"✅ Marked {len(ids)} {kind} occurrences at {occurrence:%H:%M} as sent")
+        except Exception as e:
+            logger.error(f"❌ Error recording {len(ids)} {kind} deliveries for {occurrence:%H:%M}: {e}")
+
+async def resync_due_queue():
+    """Reload the due-queue to pick up schedules changed by another process."""
+    try:
+        count = due_queue.replace(await repository.schedules(due_queue.shards, due_queue.shard_count))
+        logger.info(f"🔄 Due-queue resynced: {count} schedules queued")
     except Exception as e:
-        print(f"❌ Error in check_and_send_reminders: {e}")
+        logger.error(f"❌ Error resyncing due-queue: {e}")
 
-async def main():
-    global session
-    session = aiohttp.ClientSession()
+async def heartbeat_shards():
+    """Renew shard leases and reload the due-queue when this worker's share changes."""
+    try:
+        owned = await shard_lease.heartbeat()
+    except Exception as e:
+        logger.error(f"❌ Error renewing shard leases: {e}")
+        # Becomes empty once the leases may have lapsed, so another worker can take over safely
+        owned = shard_lease.owned()
+    rate_limiter.share_global_rate(shard_lease.workers)
+    if due_queue.set_shards(owned, shard_lease.shard_count):
+        logger.info(f"🧩 Now owning {len(owned)} of {shard_lease.shard_count} shards")
+        await resync_due_queue()
+
+async def start_scheduler():
+    """Load the due-queue and start the reminder jobs on the running event loop."""
+    start_metrics_server()
     scheduler = AsyncIOScheduler()
+    if SCHEDULER_SHARDED:
+        due_queue.set_shards(await shard_lease.heartbeat(), shard_lease.shard_count)
+        rate_limiter.share_global_rate(shard_lease.workers)
+        logger.info(f"🧩 Worker {shard_lease.worker_id} owns {len(due_queue.shards)} of {shard_lease.shard_count} shards")
+        scheduler.add_job(heartbeat_shards, 'interval', seconds=shard_lease.heartbeat_seconds)
+    count = due_queue.replace(await repository.schedules(due_queue.shards, due_queue.shard_count))
+    logger.info(f"📋 Due-queue loaded: {count} schedules queued")
     scheduler.add_job(check_and_send_reminders, 'interval', minutes=1)
+    scheduler.add_job(prerender_upcoming, 'interval', minutes=1, next_run_time=datetime.now())
+    scheduler.add_job(resync_due_queue, 'interval', minutes=DUE_QUEUE_RESYNC_MINUTES)
+    scheduler.add_job(drain_outbox, 'interval', seconds=OUTBOX_POLL_SECONDS)
     scheduler.start()
-    print(f"🚀 Chuty, your loving nurse bot, is ready to care for {random.choice(['Baby','Love'])}! 🧑‍⚕️💕")
+    return scheduler
+
+async def stop_scheduler(scheduler):
+    """Stop the jobs and hand this worker's shards back straight away."""
+    scheduler.shutdown()
+    if SCHEDULER_SHARDED:
+        try:
+            await shard_lease.release()
+        except Exception as e:
+            logger.error(f"❌ Error releasing shard leases: {e}")
+
+async def main():
+    global session
+    session = aiohttp.ClientSession()
+    scheduler = await start_scheduler()
+    logger.info(f"🚀 Chuty, your loving nurse bot, is ready to care for {random.choice(['Baby','Love'])}! 🧑‍⚕️💕")
     try:
         await asyncio.Event().wait()  # Keep the event loop running
-    except (KeyboardInterrupt, SystemExit):
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
         await session.close()
-        scheduler.shutdown()
-        print("🛑 Scheduler stopped.")
+        await stop_scheduler(scheduler)
+        await asyncio.to_thread(llm_cache.close)
+        repository.close()
+        logger.info("🛑 Scheduler stopped.")
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
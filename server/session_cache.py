@@ -0,0 +1,93 @@
+import os
+import time
+from collections import OrderedDict, deque
+from metrics import cache_result
+
+SESSION_CACHE_MAX_USERS = int(os.getenv("SESSION_CACHE_MAX_USERS", "10000"))
+HISTORY_TURNS = 5
+# Re-read /status after this long in case another bot replica changed the user's schedules
+STATUS_CACHE_TTL_SECONDS = int(os.getenv("STATUS_CACHE_TTL_SECONDS", "300"))
+
+
+def format_history(conversations):
+    """Render conversation rows (newest first) the way the prompts expect."""
+    history = "\n".join([f"User: {c['user_message']}\nBot: {c['bot_response']}" for c in conversations])
+    return history or "No recent conversation history."
+
+
+class SessionCache:
+    """Per-user cache of known users, their last few conversation turns and their rendered schedule.
+
+    Sessions are kept in LRU order and the least recently active users are
+    dropped once ``max_users`` is exceeded. A user's history is only served
+    once it has been loaded from the database in full, so appends never make
+    a partial buffer look complete.
+    """
+
+    def __init__(self, max_users=SESSION_CACHE_MAX_USERS, turns=HISTORY_TURNS):
+        self.max_users = max_users
+        self.turns = turns
+        self._sessions = OrderedDict()
+
+    def _session(self, user_phone):
+        session = self._sessions.get(user_phone)
+        if session is None:
+            session = self._sessions[user_phone] = {"known": False, "history": None, "status": None}
+            while len(self._sessions) > self.max_users:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(user_phone)
+        return session
+
+    def is_known(self, user_phone):
+        session = self._sessions.get(user_phone)
+        return bool(session and session["known"])
+
+    def mark_known(self, user_phone):
+        self._session(user_phone)["known"] = True
+
+    def history(self, user_phone):
+        """Return the cached turns (newest first), or None if not loaded."""
+        session = self._sessions.get(user_phone)
+        if not session or session["history"] is None:
+            cache_result("session_history", False)
+            return None
+        self._sessions.move_to_end(user_phone)
+        cache_result("session_history", True)
+        return list(session["history"])
+
+    def load_history(self, user_phone, conversations):
+        """Seed a user's buffer from rows fetched newest first."""
+        self._session(user_phone)["history"] = deque(conversations[:self.turns], maxlen=self.turns)
+
+    def append_turn(self, user_phone, conversation):
+        session = self._sessions.get(user_phone)
+        if session and session["history"] is not None:
+            session["history"].appendleft(conversation)
+
+    def status(self, user_phone):
+        """Return the user's rendered schedule, or None if it is missing or stale."""
+        session = self._sessions.get(user_phone)
+        status = session and session["status"]
+        if not status or status[1] < time.monotonic():
+            cache_result("status", False)
+            return None
+        cache_result("status", True)
+        return status[0]
+
+    def set_status(self, user_phone, text):
+        self._session(user_phone)["status"] = (text, time.monotonic() + STATUS_CACHE_TTL_SECONDS)
+
+    def invalidate_status(self, user_phone):
+        """Drop the rendered schedule after the user's schedules change."""
+        session = self._sessions.get(user_phone)
+        if session:
+            session["status"] = None
+
+    def invalidate(self, user_phone):
+        """Forget a user's cached history so the next read goes to the database."""
+        session = self._sessions.get(user_phone)
+        if session:
+            session["history"] = None
+
+
+session_cache = SessionCache()
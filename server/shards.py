@@ -0,0 +1,70 @@
+import os
+import time
+import socket
+import logging
+from repository import repository
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_SHARDS = int(os.getenv("SCHEDULER_SHARDS", "64"))
+SHARD_LEASE_SECONDS = int(os.getenv("SHARD_LEASE_SECONDS", "30"))
+SHARD_HEARTBEAT_SECONDS = int(os.getenv("SHARD_HEARTBEAT_SECONDS", "10"))
+
+
+class ShardLease:
+    """Ownership of a share of the ``user_phone`` hash space, held through DB leases.
+
+    Each ``heartbeat`` calls ``heartbeat_shards`` (see ``supabase_schema.sql``),
+    which registers this worker, renews its leases and moves it towards an even
+    share of the shards among the live workers: extra shards are released when
+    workers join, and free or expired ones (e.g. from a crashed worker) are
+    taken over. If heartbeats stop succeeding, ``owned`` turns empty before the
+    leases can expire in the database, so two workers never both act on a shard
+    they each believe is theirs. Queries go through ``repository``.
+    """
+
+    def __init__(self, repository, worker_id=None, shard_count=SCHEDULER_SHARDS, lease_seconds=SHARD_LEASE_SECONDS,
+                 heartbeat_seconds=SHARD_HEARTBEAT_SECONDS):
+        self.repository = repository
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.shard_count = shard_count
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self._owned = frozenset()
+        self._valid_until = 0.0
+        self.workers = 1  # Live workers as of the last heartbeat, sharing the bot's send rate
+
+    async def heartbeat(self):
+        """Renew and rebalance this worker's leases; return the shards it now owns."""
+        started = time.monotonic()
+        rows = await self.repository.run(self.repository.supabase.rpc("heartbeat_shards", {
+            "p_owner": self.worker_id,
+            "p_shards": self.shard_count,
+            "p_lease_seconds": self.lease_seconds,
+        }), "heartbeat_shards") or []
+        owned = frozenset(row["shard"] for row in rows if row["shard"] is not None)
+        if rows:
+            self.workers = max(1, rows[0]["workers"])
+        if owned != self._owned:
+            logger.info(f"Worker {self.worker_id} now owns {len(owned)} of {self.shard_count} shards")
+        self._owned = owned
+        # Stop one heartbeat short of the database lease, measured from before the call
+        self._valid_until = started + self.lease_seconds - self.heartbeat_seconds
+        return owned
+
+    def owned(self):
+        """Shards this worker may act on right now."""
+        return self._owned if time.monotonic() < self._valid_until else frozenset()
+
+    async def release(self):
+        """Give up every lease so other workers can take over without waiting for expiry."""
+        supabase = self.repository.supabase
+        await self.repository.run(supabase.table("scheduler_shards").update({"owner": None, "lease_expires_at": None}).eq(
+            "owner", self.worker_id
+        ), "scheduler_shards")
+        await self.repository.run(supabase.table("scheduler_workers").delete().eq("worker_id", self.worker_id), "scheduler_workers")
+        self._owned = frozenset()
+        self._valid_until = 0.0
+
+
+shard_lease = ShardLease(repository)
@@ -12,8 +12,10 @@ create table if not exists medications (
     quantity integer not null,
     meal_timing text not null check (meal_timing in ('before', 'after')),
     frequency text not null check (frequency in ('daily', 'every6hours')),
-    time text not null, -- 'HH:MM' format
-    sent boolean default false
+    time text not null check (time ~ '^([01]\d|2[0-3]):[0-5]\d$'), -- 'HH:MM' format
+    slot smallint generated always as (split_part(time, ':', 1)::smallint * 60 + split_part(time, ':', 2)::smallint) stored, -- minute of day
+    sent boolean default false, -- true once any occurrence has been delivered
+    last_sent_at timestamp -- local time of the last delivered occurrence
 );
 
 create table if not exists conversations (
@@ -28,6 +30,227 @@ create table if not exists reminders (
     id uuid primary key default gen_random_uuid(),
     user_phone text references users(phone) on delete cascade,
     task text not null,
-    time text not null, -- 'HH:MM' format
-    sent boolean default false
-);
\ No newline at end of file
+    time text not null check (time ~ '^([01]\d|2[0-3]):[0-5]\d$'), -- 'HH:MM' format
+    slot smallint generated always as (split_part(time, ':', 1)::smallint * 60 + split_part(time, ':', 2)::smallint) stored, -- minute of day
+    sent boolean default false, -- true once any occurrence has been delivered
+    last_sent_at timestamp -- local time of the last delivered occurrence
+);
+
+-- Existing deployments: per-occurrence delivery state for recurring schedules
+alter table medications add column if not exists last_sent_at timestamp;
+alter table reminders add column if not exists last_sent_at timestamp;
+
+-- Existing deployments: minute-of-day slot derived from time. Rows whose time is not
+-- zero-padded 'HH:MM' must be fixed or deleted first, or the column cannot be added.
+alter table medications add column if not exists slot smallint
+    generated always as (split_part(time, ':', 1)::smallint * 60 + split_part(time, ':', 2)::smallint) stored;
+alter table reminders add column if not exists slot smallint
+    generated always as (split_part(time, ':', 1)::smallint * 60 + split_part(time, ':', 2)::smallint) stored;
+
+-- Sharded scheduler: stable hash of the owner, so workers can ask for their shards only
+-- (shard = shard_hash % shard count, the same as due_queue.shard_of)
+alter table medications add column if not exists shard_hash bigint
+    generated always as (('x' || substr(md5(user_phone), 1, 8))::bit(32)::bigint) stored;
+alter table reminders add column if not exists shard_hash bigint
+    generated always as (('x' || substr(md5(user_phone), 1, 8))::bit(32)::bigint) stored;
+
+-- Indexes for the queries the bot and scheduler issue
+-- due_in_minute pages through a few slots in (slot, id) order, so each page is an index range scan
+drop index if exists medications_slot_idx;
+drop index if exists reminders_slot_idx;
+drop index if exists medications_six_hourly_idx;
+create index if not exists medications_slot_id_idx on medications (slot, id);
+create index if not exists reminders_slot_id_idx on reminders (slot, id);
+create index if not exists medications_user_phone_idx on medications (user_phone, slot);
+create index if not exists reminders_user_phone_idx on reminders (user_phone, slot);
+create index if not exists conversations_user_phone_timestamp_idx on conversations (user_phone, timestamp desc);
+
+-- The newest p_per_user turns of each of many users, newest first; one query for a whole batch
+create or replace function recent_conversations(p_phones text[], p_per_user integer default 1)
+returns table (user_phone text, user_message text, bot_response text, "timestamp" timestamptz)
+language sql
+stable
+as $$
+    select r.user_phone, r.user_message, r.bot_response, r.timestamp
+    from (
+        select c.user_phone, c.user_message, c.bot_response, c.timestamp,
+               row_number() over (partition by c.user_phone order by c.timestamp desc) as rn
+        from conversations c
+        where c.user_phone = any(p_phones)
+    ) r
+    where r.rn <= p_per_user
+    order by r.user_phone, r.timestamp desc;
+$$;
+
+-- Every schedule with its recipient, as loaded by the due-queue and shown by /status
+create or replace view schedule_entries as
+    select 'medication' as kind, m.id, m.user_phone, m.name, m.quantity, m.meal_timing, m.frequency,
+           null::text as task, m.time, m.slot, m.sent, m.last_sent_at, u.telegram_id, u.name as user_name,
+           m.shard_hash
+    from medications m left join users u on u.phone = m.user_phone
+    union all
+    select 'reminder', r.id, r.user_phone, null, null, null, 'daily',
+           r.task, r.time, r.slot, r.sent, r.last_sent_at, u.telegram_id, u.name, r.shard_hash
+    from reminders r left join users u on u.phone = r.user_phone;
+
+-- One page of the schedules in the given shards (all of them when p_shards is null), in id order
+create or replace function schedules_in_shards(
+    p_shards integer[] default null, p_shard_count integer default null, p_after uuid default null, p_limit integer default 1000
+)
+returns setof schedule_entries
+language sql
+stable
+as $$
+    select e.* from schedule_entries e
+    where (p_shards is null or e.shard_hash % p_shard_count = any(p_shards))
+      and (p_after is null or e.id > p_after)
+    order by e.id
+    limit p_limit;
+$$;
+
+-- One page of the schedules firing within p_window minutes of p_slot (minute of day), with their
+-- recipient, limited to the given shards when p_shards is set, in (slot, id) order. every6hours
+-- schedules fire at slot, slot + 360, ..., so their candidate slots are the window's slots shifted by
+-- multiples of 360; every page is then a range scan on the (slot, id) indexes after the previous one.
+drop function if exists due_in_minute(integer, integer);
+drop function if exists due_in_minute(integer, integer, integer[], integer);
+drop function if exists due_in_minute(integer, integer, integer[], integer, uuid, integer);
+create or replace function due_in_minute(
+    p_slot integer, p_window integer default 1, p_shards integer[] default null, p_shard_count integer default null,
+    p_after_slot smallint default null, p_after uuid default null, p_limit integer default 1000
+)
+returns setof schedule_entries
+language sql
+stable
+as $$
+    with slots as (
+        select ((p_slot + offs + 1440) % 1440)::smallint as slot from generate_series(-p_window, p_window) offs
+    ), six_hourly as (
+        select ((s.slot + 360 * k) % 1440)::smallint as slot from slots s, generate_series(0, 3) k
+    )
+    select e.* from schedule_entries e
+    where e.slot = any(array(select slot from six_hourly))
+      and (e.frequency = 'every6hours' or e.slot = any(array(select slot from slots)))
+      and (p_shards is null or e.shard_hash % p_shard_count = any(p_shards))
+      and (p_after is null or (e.slot, e.id) > (p_after_slot, p_after))
+    order by e.slot, e.id
+    limit p_limit;
+$$;
+-- Durable outbox of rendered reminders; one row per schedule occurrence
+create table if not exists reminder_outbox (
+    id uuid primary key default gen_random_uuid(),
+    idempotency_key text unique not null, -- '<kind>:<schedule id>:<occurrence>'
+    kind text not null check (kind in ('medication', 'reminder')),
+    schedule_id uuid not null,
+    user_phone text references users(phone) on delete cascade,
+    telegram_id text not null,
+    text text not null,
+    label text,
+    occurrence timestamp not null, -- local time of the slot being delivered
+    status text not null default 'pending' check (status in ('pending', 'sent', 'dead')),
+    attempts integer not null default 0,
+    next_attempt_at timestamp not null,
+    deadline timestamp not null, -- given up on after this
+    lease_owner text,
+    lease_expires_at timestamp,
+    last_error text,
+    sent_at timestamp,
+    created_at timestamptz default now()
+);
+
+create index if not exists reminder_outbox_ready_idx
+    on reminder_outbox (next_attempt_at) where status = 'pending';
+
+-- Atomically lease ready outbox rows to one worker; concurrent callers skip each other's rows
+create or replace function claim_outbox(p_owner text, p_now timestamp, p_lease_seconds integer, p_limit integer)
+returns setof reminder_outbox
+language sql
+as $$
+    update reminder_outbox o
+    set lease_owner = p_owner,
+        lease_expires_at = p_now + make_interval(secs => p_lease_seconds),
+        attempts = o.attempts + 1
+    where o.id in (
+        select id from reminder_outbox
+        where status = 'pending'
+          and next_attempt_at <= p_now
+          and (lease_expires_at is null or lease_expires_at < p_now)
+        order by next_attempt_at
+        limit p_limit
+        for update skip locked
+    )
+    returning o.*;
+$$;
+
+-- Sharded scheduler: each worker leases a share of the user_phone hash space
+create table if not exists scheduler_shards (
+    shard integer primary key, -- shard_hash % shard count, see the shard_hash columns
+    owner text,
+    lease_expires_at timestamptz
+);
+
+create table if not exists scheduler_workers (
+    worker_id text primary key,
+    heartbeat_at timestamptz not null
+);
+
+-- Renew a worker's leases and rebalance towards an even share among live workers.
+-- Also reports the live worker count, so workers can split the bot's send rate.
+drop function if exists heartbeat_shards(text, integer, integer);
+create or replace function heartbeat_shards(p_owner text, p_shards integer, p_lease_seconds integer)
+returns table (shard integer, workers integer)
+language plpgsql
+as $$
+declare
+    v_lease interval := make_interval(secs => p_lease_seconds);
+    v_target integer;
+    v_owned integer;
+    v_workers integer;
+begin
+    insert into scheduler_shards (shard) select generate_series(0, p_shards - 1) on conflict do nothing;
+    insert into scheduler_workers (worker_id, heartbeat_at) values (p_owner, now())
+        on conflict (worker_id) do update set heartbeat_at = now();
+    delete from scheduler_workers where heartbeat_at < now() - v_lease;
+    select count(*) into v_workers from scheduler_workers;
+    v_target := ceil(p_shards::numeric / v_workers);
+
+    update scheduler_shards s set lease_expires_at = now() + v_lease where s.owner = p_owner;
+    select count(*) into v_owned from scheduler_shards s where s.owner = p_owner and s.shard < p_shards;
+
+    if v_owned > v_target then
+        update scheduler_shards s set owner = null, lease_expires_at = null
+        where s.shard in (
+            select o.shard from scheduler_shards o where o.owner = p_owner
+            order by o.shard desc limit v_owned - v_target
+        );
+    elsif v_owned < v_target then
+        update scheduler_shards s set owner = p_owner, lease_expires_at = now() + v_lease
+        where s.shard in (
+            select f.shard from scheduler_shards f
+            where f.shard < p_shards and (f.owner is null or f.lease_expires_at < now())
+            order by f.shard limit v_target - v_owned
+            for update skip locked
+        );
+    end if;
+
+    return query select s.shard, v_workers from scheduler_shards s
+        where s.owner = p_owner and s.shard < p_shards order by s.shard;
+    if not found then
+        return query select null::integer, v_workers; -- Owns nothing yet, but still counts
+    end if;
+end;
+$$;
+
+-- Extracted meds/reminders awaiting a yes/no from the user (PENDING_STORE=supabase)
+create table if not exists pending_confirmations (
+    user_phone text primary key references users(phone) on delete cascade,
+    payload jsonb not null,
+    expires_at timestamptz not null
+);
+
+-- Rolling per-user summary of older conversation, used in place of raw history in prompts
+create table if not exists conversation_summaries (
+    user_phone text primary key references users(phone) on delete cascade,
+    summary text not null,
+    updated_at timestamptz not null default now()
+);
@@ -6,8 +6,17 @@ import logging
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
-from database import supabase
-from google.generativeai import GenerativeModel, configure
+from repository import repository
+from due_queue import due_queue
+from conversation_log import conversation_log
+from session_cache import session_cache, HISTORY_TURNS
+from history_summary import history_summarizer, compose_history
+from llm import generate, generate_variant, llm_cache
+from llm_cache import cache_key
+from intent_parser import parse_intent, normalize_time, hit_rate as parser_hit_rate
+from update_processor import PerChatUpdateProcessor
+from pending_store import pending_store
+from metrics import debug_sampled, start_metrics_server
 from datetime import datetime
 import aiohttp
 
@@ -17,12 +26,16 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-# Initialize Gemini AI
-configure(api_key=os.getenv("GEMINI_API_KEY"))
-gemini_model = GenerativeModel("gemini-2.0-flash")
-
 # Initialize Telegram bot
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Run the reminder scheduler inside the bot process so both share one due-queue
+RUN_SCHEDULER_IN_BOT = os.getenv("RUN_SCHEDULER_IN_BOT", "false").lower() == "true"
+# Public HTTPS base URL Telegram should post updates to; long polling is used when unset
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
 async def ensure_user_exists(user_id, user_name):
     """Ensure a user exists in the users table, create if not."""
@@ -32,21 +45,28 @@ async def ensure_user_exists(user_id, user_name):
         "phone": user_phone,
         "telegram_id": str(user_id)
     }
+    if session_cache.is_known(user_phone):
+        return user_phone
     try:
-        existing_user = supabase.table("users").select("*").eq("telegram_id", user_data["telegram_id"]).execute().data
+        existing_user = await repository.user_by_telegram_id(user_data["telegram_id"])
         if not existing_user:
             logger.info(f"Creating new user: {user_data}")
-            supabase.table("users").insert(user_data).execute()
+            await repository.create_user(user_data)
             logger.info(f"User created successfully: {user_phone}")
         else:
-            logger.info(f"User already exists: {user_phone}")
+            debug_sampled(logger, "User already exists: %s", user_phone)
+        session_cache.mark_known(user_phone)
         return user_phone
     except Exception as e:
         logger.error(f"Error creating user {user_phone}: {e}")
         raise
 
-async def save_conversation(user_phone, user_message, bot_response):
-    """Save conversation to Supabase."""
+async def save_conversation(user_phone, user_message, bot_response, summarize=False):
+    """Queue a conversation for a batched write to Supabase.
+
+    Only free-text turns answered by Gemini pass ``summarize``; commands and
+    canned replies don't add anything a summary needs.
+    """
     try:
         conversation_data = {
             "user_phone": user_phone,
@@ -54,18 +74,24 @@ async def save_conversation(user_phone, user_message, bot_response):
             "bot_response": bot_response,
             "timestamp": datetime.now().isoformat()
         }
-        logger.info(f"Saving conversation: {conversation_data}")
-        supabase.table("conversations").insert(conversation_data).execute()
-        logger.info(f"Conversation saved successfully")
+        debug_sampled(logger, "Saving conversation: %s", conversation_data)
+        conversation_log.append(conversation_data)
+        session_cache.append_turn(user_phone, conversation_data)
+        if summarize:
+            history_summarizer.note_turn(user_phone, conversation_data)
     except Exception as e:
         logger.error(f"Error saving conversation: {e}")
 
-async def get_conversation_history(user_phone):
-    """Retrieve recent conversation history."""
+async def get_conversation_history(user_phone, prompt_type="intent"):
+    """Retrieve the rolling summary plus the last exchange, within the prompt's token budget."""
     try:
-        conversations = supabase.table("conversations").select("*").eq("user_phone", user_phone).order("timestamp", desc=True).limit(5).execute().data
-        history = "\n".join([f"User: {c['user_message']}\nBot: {c['bot_response']}" for c in conversations])
-        return history or "No recent conversation history."
+        conversations = session_cache.history(user_phone)
+        if conversations is None:
+            conversations = await repository.recent_conversations(user_phone, HISTORY_TURNS)
+            session_cache.load_history(user_phone, conversations)
+            await history_summarizer.seed(user_phone, conversations)
+        summary = await history_summarizer.summary(user_phone)
+        return compose_history(summary, conversations, prompt_type)
     except Exception as e:
         logger.error(f"Error retrieving conversation history: {e}")
         return "No recent conversation history."
@@ -95,7 +121,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     nickname = random.choice(["Baby","Love"])
-    user_phone = f"tg_{update.effective_user.id}"
+    # Conversations reference users, so the user must exist before their first turn is logged
+    user_phone = await ensure_user_exists(update.effective_user.id, update.effective_user.first_name)
     bot_response = (
         f"Hi {nickname}! I'm Chuty, your nurse bot. 🌸 Here's how to chat:\n"
         "💊 Meds: 'Fexet night 1' → 1 Fexet at night\n"
@@ -106,50 +133,92 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(bot_response)
     await save_conversation(user_phone, "/help", bot_response)
 
-async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    nickname = random.choice(["Baby", "Love"])
-    user_phone = f"tg_{user_id}"
-    meds = supabase.table("medications").select("*").eq("user_phone", user_phone).execute().data
-    reminders = supabase.table("reminders").select("*").eq("user_phone", user_phone).execute().data
-    bot_response = f"Your schedule, my dear {nickname}:\n"
+def format_schedule(entries):
+    """Render ``(kind, row)`` schedule entries in time-of-day order for /status; "" when there are none."""
+    meds = [
+        f"  {med['name']} - {med['quantity']} ({med['frequency']}, {med['meal_timing']} meal) at {med['time']}\n"
+        for kind, med in entries if kind == "medication"
+    ]
+    reminders = [f"  {rem['task']} at {rem['time']}\n" for kind, rem in entries if kind == "reminder"]
+    parts = []
     if meds:
-        bot_response += "\n💊 Medications:\n"
-        for med in meds:
-            bot_response += f"  {med['name']} - {med['quantity']} ({med['frequency']}, {med['meal_timing']} meal) at {med['time']}\n"
+        parts.append("\n💊 Medications:\n" + "".join(meds))
     if reminders:
-        bot_response += "\n💧 Reminders:\n"
-        for rem in reminders:
-            bot_response += f"  {rem['task']} at {rem['time']}\n"
-    if not (meds or reminders):
+        parts.append("\n💧 Reminders:\n" + "".join(reminders))
+    return "".join(parts)
+
+async def schedule_text(user_phone):
+    """The user's rendered schedule, rebuilt only after it changed or the cached copy expired."""
+    text = session_cache.status(user_phone)
+    if text is None:
+        # The scheduler's due-queue holds the same rows when it runs in this process
+        entries = due_queue.user_entries(user_phone)
+        if entries is None:
+            entries = [(entry["kind"], entry) for entry in await repository.schedule_entries(user_phone)]
+        text = format_schedule(entries)
+        session_cache.set_status(user_phone, text)
+    return text
+
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    nickname = random.choice(["Baby", "Love"])
+    user_phone = await ensure_user_exists(update.effective_user.id, update.effective_user.first_name)
+    schedule = await schedule_text(user_phone)
+    if schedule:
+        bot_response = f"Your schedule, my dear {nickname}:\n{schedule}"
+    else:
         bot_response = f"No meds or reminders yet, {nickname}! Tell me what you need, and I’ll care for you. 💕\n"
     bot_response += f"How can I help you feel better today? 🌟"
     await update.message.reply_text(bot_response)
     await save_conversation(user_phone, "/status", bot_response)
 
 async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
     nickname = random.choice(["Baby", "Love"])
-    user_phone = f"tg_{user_id}"
-    supabase.table("medications").delete().eq("user_phone", user_phone).execute()
-    supabase.table("reminders").delete().eq("user_phone", user_phone).execute()
+    user_phone = await ensure_user_exists(update.effective_user.id, update.effective_user.first_name)
+    await repository.delete_schedules(user_phone)
+    if RUN_SCHEDULER_IN_BOT:
+        due_queue.remove_user(user_phone)
+    session_cache.invalidate(user_phone)
+    session_cache.invalidate_status(user_phone)
+    await pending_store.clear(user_phone)
     bot_response = f"All your meds and reminders are cleared, {nickname}. Ready for a fresh start? 😊 How’s your health today? 💖"
     await update.message.reply_text(bot_response)
     await save_conversation(user_phone, "/clear", bot_response)
 
 async def love(update: Update, context: ContextTypes.DEFAULT_TYPE):
     nickname = random.choice(["Baby","Love"])
-    user_phone = f"tg_{update.effective_user.id}"
+    user_phone = await ensure_user_exists(update.effective_user.id, update.effective_user.first_name)
     prompt = f"Generate a short, loving message for {nickname}, using a warm, affectionate tone with emojis (💖, 🌸, 😘). Use only the nickname {nickname}. Keep it sweet and under 50 words."
     try:
-        response = gemini_model.generate_content(prompt)
-        bot_response = response.text.strip()
+        bot_response = await generate_variant(cache_key("love", nickname), prompt)
     except Exception as e:
         logger.error(f"Error generating love message: {e}")
         bot_response = f"Just a little note, {nickname}, to say I adore you! 😘"
     await update.message.reply_text(bot_response)
     await save_conversation(user_phone, "/love", bot_response)
 
+def grounded_in(message, med_data_list, rem_data_list):
+    """Whether every extracted name and task is spelled out in the message itself.
+
+    Gemini also reads the conversation history, so a follow-up like "add it
+    at night too" can come back with a name only that user mentioned. Such
+    results must not be cached under the message text, where anyone sending
+    the same words would be offered them.
+    """
+    text = " ".join(message.lower().split())
+    labels = [med.get("name") for med in med_data_list] + [rem.get("task") for rem in rem_data_list]
+    return all(label and " ".join(str(label).lower().split()) in text for label in labels)
+
+def confirmation_response(nickname, med_data_list, rem_data_list):
+    """Build the 'is this right?' reply for extracted medications and reminders."""
+    expected_response = f"Got it, {nickname}! 💖"
+    for med_data in med_data_list:
+        time_label = "night" if med_data["time"] == "20:00" else "time"
+        expected_response += f" {med_data['name']} {med_data['quantity']} at {med_data['time']} ({time_label})."
+    for rem_data in rem_data_list:
+        expected_response += f" {rem_data['task'].capitalize()} at {rem_data['time']}."
+    expected_response += f" Is this right? 😊 Reply ‘yes’ or ‘no, new time (e.g., 18:00)’ to change. 💕"
+    return expected_response
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_message = update.message.text.lower().strip()
     user_id = str(update.effective_user.id)
@@ -168,78 +237,103 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check if user is confirming a previous medication or reminder
-    if context.user_data.get("pending_medications") or context.user_data.get("pending_reminders"):
-        pending_meds = context.user_data.get("pending_medications", [])
-        pending_reminders = context.user_data.get("pending_reminders", [])
+    pending = await pending_store.get(user_phone)
+    if pending:
+        pending_meds, pending_reminders = pending
         if user_message.startswith("yes"):
-            # Save medications
-            for med_data in pending_meds:
-                times = med_data.get("time", "08:00").split(",")
-                for time in times:
-                    med = {
-                        "user_phone": user_phone,
-                        "name": med_data["name"],
-                        "quantity": med_data["quantity"],
-                        "meal_timing": med_data["meal_timing"],
-                        "frequency": med_data["frequency"],
-                        "time": time.strip(),
-                        "sent": False
-                    }
-                    logger.info(f"Inserting confirmed medication into Supabase: {med}")
-                    try:
-                        supabase.table("medications").insert(med).execute()
-                    except Exception as e:
-                        logger.error(f"Error inserting medication {med['name']}: {e}")
-                        bot_response = f"Oh, {nickname}, I couldn’t save {med['name']}! 😔 Please try again. 💕"
-                        await update.message.reply_text(bot_response)
-                        await save_conversation(user_phone, user_message, bot_response)
-                        return
-            # Save reminders
-            for rem_data in pending_reminders:
-                rem = {
+            meds = [
+                {
+                    "user_phone": user_phone,
+                    "name": med_data["name"],
+                    "quantity": med_data["quantity"],
+                    "meal_timing": med_data["meal_timing"],
+                    "frequency": med_data["frequency"],
+                    "time": normalize_time(time),
+                    "sent": False
+                }
+                for med_data in pending_meds
+                for time in (med_data.get("time") or "08:00").split(",")
+            ]
+            rems = [
+                {
                     "user_phone": user_phone,
                     "task": rem_data["task"],
-                    "time": rem_data["time"],
+                    "time": normalize_time(rem_data.get("time") or ""),
                     "sent": False
                 }
-                logger.info(f"Inserting confirmed reminder into Supabase: {rem}")
+                for rem_data in pending_reminders
+            ]
+            # The tables only accept 'HH:MM', so ask again rather than fail the insert
+            if any(row["time"] is None for row in meds + rems):
+                bot_response = f"Hmm, {nickname}, I couldn’t read one of those times. 😊 Reply ‘no, new time (e.g., 18:00)’ to set it. 💕"
+                await update.message.reply_text(bot_response)
+                await save_conversation(user_phone, user_message, bot_response)
+                return
+            # One bulk insert per table instead of one per time slot
+            for table, kind, rows, label in (("medications", "medication", meds, "meds"), ("reminders", "reminder", rems, "reminders")):
+                if not rows:
+                    continue
+                logger.info(f"Inserting {len(rows)} confirmed {table} for {user_phone}")
+                debug_sampled(logger, "Confirmed %s: %s", table, rows)
                 try:
-                    supabase.table("reminders").insert(rem).execute()
+                    stored = await repository.insert_schedules(kind, rows)
+                    # Only a scheduler running in this process reads this queue
+                    if RUN_SCHEDULER_IN_BOT:
+                        for row in stored:
+                            due_queue.add(kind, row)
+                    session_cache.invalidate_status(user_phone)
                 except Exception as e:
-                    logger.error(f"Error inserting reminder {rem['task']}: {e}")
-                    bot_response = f"Oh, {nickname}, I couldn’t save the {rem['task']} reminder! 😔 Please try again. 💕"
+                    logger.error(f"Error inserting {len(rows)} {table}: {e}")
+                    bot_response = f"Oh, {nickname}, I couldn’t save your {label}! 😔 Please try again. 💕"
                     await update.message.reply_text(bot_response)
                     await save_conversation(user_phone, user_message, bot_response)
                     return
-            context.user_data["pending_medications"] = []
-            context.user_data["pending_reminders"] = []
+                # Medications are saved; a retried "yes" should only redo the reminders
+                if table == "medications":
+                    await pending_store.set(user_phone, [], pending_reminders)
+            await pending_store.clear(user_phone)
             bot_response = f"All set, my dear {nickname}! Your meds and reminders are saved. 💖 How are you feeling today? 😘"
             await update.message.reply_text(bot_response)
             await save_conversation(user_phone, user_message, bot_response)
             return
         elif user_message.startswith("no"):
-            new_times = user_message.replace("no", "").strip().split(",")
-            if new_times and new_times[0]:
+            new_times = [time for time in user_message.replace("no", "").strip(" ,").split(",") if time.strip()]
+            if new_times and None in map(normalize_time, new_times):
+                bot_response = f"Hmm, {nickname}, I couldn’t read that time. 😊 Try ‘no, 18:00’ or ‘no, 9pm’. 💕"
+                await update.message.reply_text(bot_response)
+                await save_conversation(user_phone, user_message, bot_response)
+                return
+            new_times = [normalize_time(time) for time in new_times]
+            if new_times:
                 for med_data in pending_meds:
                     med_data["time"] = ",".join(new_times)
-                    med_data["confirmation"] = f"Is {','.join(new_times)} okay for {med_data['name']}, {nickname}?"
                 for rem_data in pending_reminders:
                     rem_data["time"] = new_times[0]
-                    rem_data["confirmation"] = f"Is {new_times[0]} okay for {rem_data['task']}, {nickname}?"
-                context.user_data["pending_medications"] = pending_meds
-                context.user_data["pending_reminders"] = pending_reminders
+                await pending_store.set(user_phone, pending_meds, pending_reminders)
                 bot_response = f"Okay, {nickname}, I’ve updated the times to {','.join(new_times)}. Is that right? 😊 Reply ‘yes’ or ‘no, new time (e.g., 18:00)’ to change. 💕"
                 await update.message.reply_text(bot_response)
                 await save_conversation(user_phone, user_message, bot_response)
                 return
             else:
-                context.user_data["pending_medications"] = []
-                context.user_data["pending_reminders"] = []
+                await pending_store.clear(user_phone)
                 bot_response = f"No worries, {nickname}. Let’s try again. Tell me about your meds, reminders, or health! 🌸"
                 await update.message.reply_text(bot_response)
                 await save_conversation(user_phone, user_message, bot_response)
                 return
 
+    # Try the local parser, then cached intents; only fall through to Gemini on a miss
+    intent_key = cache_key("intent", user_message)
+    parsed = parse_intent(user_message, nickname) or llm_cache.get(intent_key)
+    if parsed:
+        med_data_list = parsed["medication"]
+        rem_data_list = parsed["reminders"]
+        debug_sampled(logger, "Fast-path parse hit (parser hit rate %.0f%%): %s, %s", parser_hit_rate() * 100, med_data_list, rem_data_list)
+        await pending_store.set(user_phone, med_data_list, rem_data_list)
+        bot_response = confirmation_response(nickname, med_data_list, rem_data_list)
+        await update.message.reply_text(bot_response)
+        await save_conversation(user_phone, user_message, bot_response)
+        return
+
     # Fetch conversation history
     conversation_history = await get_conversation_history(user_phone)
 
@@ -274,9 +368,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     async with aiohttp.ClientSession() as session:
         for attempt in range(3):
             try:
-                response = gemini_model.generate_content(prompt)
-                logger.info(f"Gemini raw response: {response.text}")
-                response_text = response.text.strip()
+                raw_response = await generate(prompt)
+                debug_sampled(logger, "Gemini raw response: %s", raw_response)
+                response_text = raw_response
                 if response_text.startswith("```json") and response_text.endswith("```"):
                     response_text = response_text[7:-3].strip()
                 result = json.loads(response_text)
@@ -286,26 +380,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 # Validate and construct response
                 if med_data_list or rem_data_list:
-                    expected_response = f"Got it, {nickname}! 💖"
-                    if med_data_list:
-                        for med_data in med_data_list:
-                            time_label = "night" if med_data["time"] == "20:00" else "time"
-                            expected_response += f" {med_data['name']} {med_data['quantity']} at {med_data['time']} ({time_label})."
-                    if rem_data_list:
-                        for rem_data in rem_data_list:
-                            expected_response += f" {rem_data['task'].capitalize()} at {rem_data['time']}."
-                    expected_response += f" Is this right? 😊 Reply ‘yes’ or ‘no, new time (e.g., 18:00)’ to change. 💕"
-                    bot_response = expected_response  # Override with correct format
-
-                context.user_data["pending_medications"] = med_data_list
-                context.user_data["pending_reminders"] = rem_data_list
-                logger.info(f"Pending medications: {med_data_list}, Pending reminders: {rem_data_list}")
+                    bot_response = confirmation_response(nickname, med_data_list, rem_data_list)  # Override with correct format
+                    if grounded_in(user_message, med_data_list, rem_data_list):
+                        llm_cache.set(intent_key, {"medication": med_data_list, "reminders": rem_data_list})
+
+                await pending_store.set(user_phone, med_data_list, rem_data_list)
+                debug_sampled(logger, "Pending medications: %s, Pending reminders: %s", med_data_list, rem_data_list)
                 await update.message.reply_text(bot_response)
-                await save_conversation(user_phone, user_message, bot_response)
+                await save_conversation(user_phone, user_message, bot_response, summarize=True)
                 return
 
             except json.JSONDecodeError as je:
-                logger.error(f"JSON parse error (attempt {attempt + 1}): {je} - Raw response: {response.text}")
+                logger.error(f"JSON parse error (attempt {attempt + 1}): {je} - Raw response: {raw_response}")
                 bot_response = f"Oh, {nickname}, I got a bit confused! Could you tell me about your meds, reminders, or health again? 😊"
                 await update.message.reply_text(bot_response)
                 await save_conversation(user_phone, user_message, bot_response)
@@ -320,8 +406,31 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await save_conversation(user_phone, user_message, bot_response)
                 return
 
+async def post_init(app):
+    start_metrics_server()
+    conversation_log.start()
+    if RUN_SCHEDULER_IN_BOT:
+        from scheduler import start_scheduler
+        app.bot_data["scheduler"] = await start_scheduler()
+
+async def post_shutdown(app):
+    if "scheduler" in app.bot_data:
+        from scheduler import stop_scheduler
+        await stop_scheduler(app.bot_data["scheduler"])
+    await history_summarizer.stop()
+    await conversation_log.stop()
+    await asyncio.to_thread(llm_cache.close)
+    repository.close()
+
 def run_bot():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("status", status))
@@ -329,7 +438,18 @@ def run_bot():
     app.add_handler(CommandHandler("love", love))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     print(f"✅ Chuty, your loving nurse bot, is ready to care for {random.choice(['Baby','Love'])}! 🧑‍⚕️💖")
-    app.run_polling(poll_interval=1)
+    if WEBHOOK_URL:
+        # Local HTTP listener, typically behind a TLS-terminating reverse proxy
+        print(f"🌐 Listening for webhook updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling(poll_interval=1)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+from due_queue import DueQueue, occurrence_at, occurrence_slots
+
+
+def schedule(row_id, time, frequency="daily", last_sent_at=None):
+    return {
+        "kind": "medication", "id": row_id, "user_phone": "tg_1", "name": "Fexet", "time": time,
+        "frequency": frequency, "last_sent_at": last_sent_at,
+    }
+
+
+def queue(*rows):
+    due_queue = DueQueue()
+    due_queue.replace([dict(row) for row in rows])
+    return due_queue
+
+
+def due_ids(due):
+    return sorted((row["id"], occurrence) for kind, row, occurrence in due)
+
+
+def test_occurrence_at_wraps_midnight():
+    assert occurrence_at(datetime(2026, 1, 1, 23, 59), 0) == datetime(2026, 1, 2, 0, 0)
+    assert occurrence_at(datetime(2026, 1, 2, 0, 0), 23 * 60 + 59) == datetime(2026, 1, 1, 23, 59)
+    assert occurrence_at(datetime(2026, 1, 1, 9, 0, 30), 9 * 60) == datetime(2026, 1, 1, 9, 0)
+
+
+def test_occurrence_slots():
+    assert occurrence_slots("daily", 90) == [90]
+    assert occurrence_slots(None, 90) == [90]
+    assert occurrence_slots("every6hours", 90) == [90, 450, 810, 1170]
+    assert occurrence_slots("every6hours", 23 * 60) == [300, 660, 1020, 1380]
+
+
+def test_pop_due_across_midnight():
+    due_queue = queue(schedule("a", "23:59"), schedule("b", "00:00"), schedule("c", "00:02"))
+    assert due_ids(due_queue.pop_due(datetime(2026, 1, 2, 0, 0))) == [
+        ("a", datetime(2026, 1, 1, 23, 59)), ("b", datetime(2026, 1, 2, 0, 0)),
+    ]
+
+
+def test_every6hours_fires_at_each_slot():
+    due_queue = queue(schedule("a", "02:00", "every6hours"))
+    for hour in (2, 8, 14, 20):
+        now = datetime(2026, 1, 1, hour, 0)
+        due = due_queue.pop_due(now)
+        assert due_ids(due) == [("a", now)]
+        for kind, row, occurrence in due:
+            due_queue.complete(kind, row, occurrence)
+    assert due_queue.pop_due(datetime(2026, 1, 1, 11, 0)) == []
+
+
+def test_fires_again_the_next_day():
+    due_queue = queue(schedule("a", "09:00"))
+    today = datetime(2026, 1, 1, 9, 0)
+    [(kind, row, occurrence)] = due_queue.pop_due(today)
+    due_queue.complete(kind, row, occurrence)
+    assert due_queue.pop_due(today + timedelta(minutes=1)) == []
+    tomorrow = today + timedelta(days=1)
+    assert due_ids(due_queue.pop_due(tomorrow)) == [("a", tomorrow)]
+
+
+def test_claimed_occurrence_is_requeued_then_completed():
+    due_queue = queue(schedule("a", "09:00"))
+    now = datetime(2026, 1, 1, 9, 0)
+    [(kind, row, occurrence)] = due_queue.pop_due(now)
+    assert due_queue.pop_due(now) == []  # In flight
+    due_queue.requeue(kind, row, occurrence)
+    [(kind, row, occurrence)] = due_queue.pop_due(now + timedelta(minutes=1))
+    assert occurrence == now
+    due_queue.complete(kind, row, occurrence)
+    assert due_queue.pop_due(now + timedelta(minutes=1)) == []
+    assert due_queue.get("medication", "a")["last_sent_at"] == now
+
+
+def test_replace_and_merge_keep_deliveries_recorded_in_memory():
+    due_queue = queue(schedule("a", "09:00"))
+    now = datetime(2026, 1, 1, 9, 0)
+    [(kind, row, occurrence)] = due_queue.pop_due(now)
+    due_queue.complete(kind, row, occurrence)
+    # The database hasn't seen last_sent_at yet
+    due_queue.replace([schedule("a", "09:00"), schedule("b", "09:01")])
+    due_queue.merge([schedule("a", "09:00")])
+    assert due_ids(due_queue.pop_due(now)) == [("b", datetime(2026, 1, 1, 9, 1))]
+    assert len(due_queue) == 2
@@ -0,0 +1,65 @@
+import pytest
+from intent_parser import parse_intent, parse_clock, normalize_time
+
+
+def medication(message):
+    result = parse_intent(message, "Baby")
+    assert result is not None and len(result["medication"]) == 1 and not result["reminders"]
+    return result["medication"][0]
+
+
+def reminder(message):
+    result = parse_intent(message, "Baby")
+    assert result is not None and len(result["reminders"]) == 1 and not result["medication"]
+    return result["reminders"][0]
+
+
+def test_help_medication_format():
+    med = medication("Fexet night 1")
+    assert (med["name"], med["quantity"], med["time"], med["frequency"]) == ("Fexet", 1, "20:00", "daily")
+
+
+def test_help_reminder_format():
+    rem = reminder("Drink water at 4:45 PM")
+    assert (rem["task"], rem["time"]) == ("drink water", "16:45")
+
+
+@pytest.mark.parametrize("message, name, quantity, time, meal_timing, frequency", [
+    ("I take 2 aspirin tablets daily after breakfast", "Aspirin", 2, "08:00", "after", "daily"),
+    ("Remind me to take lisinopril 5mg twice a day before meals", "Lisinopril 5mg", 1, "08:00,20:00", "before", "daily"),
+    ("vitamin d 1000 iu once daily", "Vitamin D 1000iu", 1, "08:00", "before", "daily"),
+    ("paracetamol every 6 hours", "Paracetamol", 1, "08:00", "before", "every6hours"),
+    ("I take blood pressure medicine every morning", "Blood Pressure Medicine", 1, "08:00", "before", "daily"),
+])
+def test_medication_formats(message, name, quantity, time, meal_timing, frequency):
+    med = medication(message)
+    assert (med["name"], med["quantity"], med["time"], med["meal_timing"], med["frequency"]) == (
+        name, quantity, time, meal_timing, frequency
+    )
+
+
+@pytest.mark.parametrize("message", [
+    "good morning", "Good night!", "bad night", "rough morning", "happy afternoon", "sleep well tonight",
+    "lovely evening", "nice night", "fexet at night", "2 beers tonight", "3 glasses water", "take 2 cups coffee daily",
+])
+def test_greetings_and_bare_times_go_to_gemini(message):
+    assert parse_intent(message, "Baby") is None
+
+
+@pytest.mark.parametrize("message", ["I have a cold", "going to a party tonight", "yes", ""])
+def test_free_text_goes_to_gemini(message):
+    assert parse_intent(message, "Baby") is None
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("4:45 pm", "16:45"), ("9pm", "21:00"), ("21:00", "21:00"), ("09:30", "09:30"), ("4:45", None), ("13:75", None),
+])
+def test_parse_clock(text, expected):
+    assert parse_clock(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("9:00", "09:00"), (" 18:30", "18:30"), ("9pm", "21:00"), ("7:15 AM", "07:15"), ("24:00", None), ("soon", None),
+])
+def test_normalize_time(text, expected):
+    assert normalize_time(text) == expected
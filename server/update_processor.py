@@ -0,0 +1,104 @@
+import os
+import time
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+BOT_MAX_CONCURRENT_UPDATES = int(os.getenv("BOT_MAX_CONCURRENT_UPDATES", "64"))
+# Updates accepted at once, including those queued behind their chat; bounds memory under a flood
+BOT_MAX_QUEUED_UPDATES = int(os.getenv("BOT_MAX_QUEUED_UPDATES", "4096"))
+UPDATE_METRICS_SECONDS = int(os.getenv("UPDATE_METRICS_SECONDS", "60"))
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats concurrently, each chat in order.
+
+    The base class only caps how many updates are accepted
+    (``max_queued_updates``). Each update then waits on its chat's lock
+    before taking one of this class's ``max_concurrent_updates`` slots, so a
+    user sending several messages in a row holds at most one slot and their
+    pending confirmation (see ``pending_store``) never sees two of their
+    messages at once. Queue depth and handling time are logged every
+    ``UPDATE_METRICS_SECONDS``.
+    """
+
+    def __init__(self, max_concurrent_updates=BOT_MAX_CONCURRENT_UPDATES, max_queued_updates=BOT_MAX_QUEUED_UPDATES):
+        super().__init__(max(max_queued_updates, max_concurrent_updates))
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks = {}
+        self._chat_waiters = {}
+        self._metrics_task = None
+        self.stats = {"processed": 0, "waiting": 0, "active": 0, "max_waiting": 0, "busiest_chat_depth": 0}
+        self._durations = []
+        registry.gauge("bot_update_queue_depth", "Updates received but not yet being handled", self.queue_depth)
+        registry.gauge("bot_updates_active", "Updates being handled right now", lambda: self.stats["active"])
+        self._handling_seconds = registry.histogram("bot_update_seconds", "Time spent handling one update")
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = update.effective_chat.id if isinstance(update, Update) and update.effective_chat else None
+        self.stats["waiting"] += 1
+        self.stats["max_waiting"] = max(self.stats["max_waiting"], self.stats["waiting"])
+        try:
+            if chat_id is None:
+                await self._handle(coroutine)
+                return
+            lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+            depth = self._chat_waiters[chat_id] = self._chat_waiters.get(chat_id, 0) + 1
+            self.stats["busiest_chat_depth"] = max(self.stats["busiest_chat_depth"], depth)
+            try:
+                async with lock:
+                    await self._handle(coroutine)
+            finally:
+                self._chat_waiters[chat_id] -= 1
+                if not self._chat_waiters[chat_id]:
+                    del self._chat_waiters[chat_id]
+                    del self._chat_locks[chat_id]
+        finally:
+            self.stats["processed"] += 1
+
+    async def _handle(self, coroutine):
+        async with self._slots:
+            self.stats["waiting"] -= 1
+            self.stats["active"] += 1
+            started = time.monotonic()
+            try:
+                await coroutine
+            finally:
+                self.stats["active"] -= 1
+                self._durations.append(time.monotonic() - started)
+                self._handling_seconds.observe(self._durations[-1])
+
+    def queue_depth(self):
+        """Updates received but not yet being handled, across all chats."""
+        return self.stats["waiting"]
+
+    async def _log_metrics(self):
+        while True:
+            await asyncio.sleep(UPDATE_METRICS_SECONDS)
+            durations, self._durations = sorted(self._durations), []
+            if not durations:
+                continue
+            p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+            logger.info(
+                f"Updates: {len(durations)} handled in the last {UPDATE_METRICS_SECONDS}s, "
+                f"p95 {p95:.2f}s, queue depth {self.queue_depth()}, {self.stats}"
+            )
+            self.stats["max_waiting"] = self.stats["waiting"]
+            self.stats["busiest_chat_depth"] = max(self._chat_waiters.values(), default=0)
+
+    async def initialize(self):
+        if self._metrics_task is None:
+            self._metrics_task = asyncio.get_running_loop().create_task(self._log_metrics())
+
+    async def shutdown(self):
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            try:
+                await self._metrics_task
+            except asyncio.CancelledError:
+                pass
+            self._metrics_task = None